@@ -0,0 +1,436 @@
+"""
+Бенчмарк этапов загрузки данных Itresume.
+
+Скрипт генерирует синтетические записи в формате API, поднимает локальный
+HTTP-сервер вместо API_URL и замеряет по отдельности:
+1. Скачивание (целиком и в потоковом режиме)
+2. Валидацию RecordValidator.process_records (пачками и для сравнения по одной записи)
+3. Сохранение в CSV
+4. Кодирование строк для COPY (CSV и бинарный формат)
+5. Загрузку в PostgreSQL (локальная база или фейковый курсор)
+
+С локальной базой (--dsn) бинарный COPY дополнительно сверяется с текстовым
+построчно: обе версии грузятся во временные таблицы и сравниваются через EXCEPT ALL.
+
+Для каждого этапа считается время, скорость (записей в секунду) и пиковая
+память по tracemalloc. Результаты сохраняются в JSON, чтобы сравнивать
+запуски до и после оптимизаций.
+
+Пример:
+    python benchmark_itresume_etl.py --records 200000 --error-rate 0.1 --output bench.json
+"""
+
+import argparse
+import json
+import logging
+import platform
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import training_itresume_etl as etl
+
+DATE_FORMAT = etl.DATE_FORMAT
+
+# Доли ошибок разных видов среди невалидных записей
+DEFAULT_ERROR_MIX = {
+    'bad_user_id': 1,
+    'bad_date': 1,
+    'future_date': 1,
+    'bad_attempt_type': 1,
+    'bad_is_correct': 1,
+    'bad_passback_params': 1
+}
+
+CONSUMER_KEYS = ['', 'skillfactory', 'sf-lms', 'partner-key']
+COURSES = ['DST-3.0+28FEB2021', 'PYTHON-2.0+01JAN2022', 'SQL-1.0+15MAR2022']
+
+# ------------------------------------------------------
+# Генератор синтетических записей
+# ------------------------------------------------------
+
+def make_passback_params(rng: random.Random) -> str:
+    course = rng.choice(COURSES)
+    block = '%032x' % rng.getrandbits(128)
+    return str({
+        'oauth_consumer_key': rng.choice(CONSUMER_KEYS),
+        'lis_result_sourcedid': f"course-v1:SkillFactory+{course}:lms.skillfactory.ru-{block}:"
+                                f"{'%032x' % rng.getrandbits(128)}",
+        'lis_outcome_service_url': f"https://lms.skillfactory.ru/courses/course-v1:SkillFactory+{course}"
+                                   f"/xblock/block-v1:SkillFactory+{course}+type@lti+block@{block}"
+                                   f"/handler_noauth/outcome_service_handler"
+    })
+
+def spoil_record(record: dict, kind: str, rng: random.Random):
+    if kind == 'bad_user_id':
+        record['lti_user_id'] = rng.choice(['', None, 'not-a-hex-id', record['lti_user_id'][:20]])
+    elif kind == 'bad_date':
+        record['created_at'] = rng.choice(['', '2023-13-01 00:00:00.000000', '01.04.2023'])
+    elif kind == 'future_date':
+        record['created_at'] = (datetime.now() + timedelta(days=365)).strftime(DATE_FORMAT)
+    elif kind == 'bad_attempt_type':
+        record['attempt_type'] = rng.choice([None, '', 'check'])
+    elif kind == 'bad_is_correct':
+        record['is_correct'] = 'maybe' if record['attempt_type'] == 'submit' else True
+    elif kind == 'bad_passback_params':
+        record['passback_params'] = rng.choice(['', '{broken', "{'oauth_consumer_key': None}"])
+
+def record_timestamps(count: int, start: datetime, end: datetime):
+    step = (end - start) / max(count, 1)
+    return [(start + step * i).strftime(DATE_FORMAT) for i in range(count)]
+
+# Записи равномерно распределены по интервалу start-end и отсортированы по created_at
+def generate_records(count: int, start: datetime, end: datetime, error_rate: float = 0.1,
+                     error_mix: dict = None, users: int = 1000, passback_variants: int = 500,
+                     seed: int = 0):
+    rng = random.Random(seed)
+    error_mix = error_mix or DEFAULT_ERROR_MIX
+    error_kinds = list(error_mix)
+    error_weights = [error_mix[kind] for kind in error_kinds]
+
+    user_ids = ['%032x' % rng.getrandbits(128) for _ in range(users)]
+    # Ограниченный набор passback_params, как в реальных данных
+    passback_pool = [make_passback_params(rng) for _ in range(passback_variants)]
+    records = []
+    for created_at in record_timestamps(count, start, end):
+        attempt_type = rng.choice(['run', 'submit'])
+        record = {
+            'lti_user_id': rng.choice(user_ids),
+            'passback_params': rng.choice(passback_pool),
+            'is_correct': rng.choice([True, False]) if attempt_type == 'submit' else None,
+            'attempt_type': attempt_type,
+            'created_at': created_at
+        }
+        if rng.random() < error_rate:
+            spoil_record(record, rng.choices(error_kinds, error_weights)[0], rng)
+        records.append(record)
+    return records
+
+# ------------------------------------------------------
+# Локальная заглушка API
+# ------------------------------------------------------
+
+class StubApiServer:
+    # timestamps - исходная дата каждой записи: по ней запись попадает в окно start-end,
+    # даже если ее created_at испорчен генератором
+    def __init__(self, records, timestamps, host='127.0.0.1', port=0):
+        self.records = records
+        self.timestamps = timestamps
+        self.bytes_sent = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                start, end = query['start'][0], query['end'][0]
+                body = json.dumps([record for record, ts in zip(server.records, server.timestamps)
+                                   if start <= ts <= end]).encode('utf-8')
+                server.bytes_sent += len(body)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.httpd.server_address[1]}/api/statistics"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# ------------------------------------------------------
+# Фейковое подключение к PostgreSQL
+# ------------------------------------------------------
+
+# Ведет себя как соединение psycopg2 настолько, насколько это нужно загрузчику:
+# COPY вычитывает поток так же, как это делает настоящий copy_expert
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 0
+        self._result = None
+
+    def execute(self, query, params=None):
+        query = ' '.join(query.split()).upper()
+        if query.startswith('CREATE TEMP TABLE'):
+            # Соединение переиспользуется пулом: каждая пачка считает только свои строки
+            self.connection.staged_rows = 0
+            self._result = None
+        elif query.startswith('INSERT INTO TRAINING_DATA'):
+            self.rowcount = self.connection.staged_rows
+        elif 'COUNT(*)' in query or 'RELTUPLES' in query:
+            self._result = (self.connection.staged_rows,)
+        elif 'PG_ATTRIBUTE' in query:
+            # Таблица уже есть, обычная схема без секций
+            self._result = ('r', False)
+        elif 'TRAINING_DAILY_STATS' in query:
+            # Сводной таблицы нет
+            self._result = (False,)
+        elif 'SELECT EXISTS' in query or 'TO_REGCLASS' in query:
+            self._result = (True,)
+        else:
+            self._result = None
+
+    def copy_expert(self, query, file, size=8192):
+        while True:
+            data = file.read(size)
+            if not data:
+                break
+            self.connection.bytes_copied += len(data.encode('utf-8') if isinstance(data, str) else data)
+            self.connection.staged_rows += data.count('\n') if isinstance(data, str) else 0
+
+    def fetchone(self):
+        return self._result
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    # Пул psycopg2 смотрит на closed и статус транзакции, когда соединение возвращают
+    info = type('FakeConnectionInfo', (), {'transaction_status': 0})()
+
+    def __init__(self, *args, **kwargs):
+        self.bytes_copied = 0
+        self.staged_rows = 0
+        self.closed = 0
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+# ------------------------------------------------------
+# Бинарный COPY против текстового
+# ------------------------------------------------------
+
+def copy_to_temp_table(cur, table, rows, copy_format):
+    cur.execute(f"CREATE TEMP TABLE {table} ({etl.STAGING_COLUMNS[False]}) ON COMMIT DROP")
+    columns = ', '.join(etl.CSV_FIELDNAMES)
+    if copy_format == 'binary':
+        copy_file = etl.IteratorFile(etl.iter_binary_copy(rows, etl.BINARY_ENCODERS[False]), binary=True)
+        cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT binary)", copy_file)
+    else:
+        cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH CSV", etl.IteratorFile(etl.iter_csv_lines(rows)))
+
+# Записи, которые проходят валидацию необычным путем: через literal_eval с нестроковыми значениями
+# в passback_params и с датой, которую разбирает только strptime
+NON_STRING_PASSBACK_RECORDS = [
+    {'lti_user_id': 'a' * 32, 'is_correct': None, 'attempt_type': 'run', 'created_at': '2023-04-01 10:00:00.000000',
+     'passback_params': "{'oauth_consumer_key': %r, 'lis_result_sourcedid': 'course-v1:SkillFactory+DST-3.0:block', "
+                        "'lis_outcome_service_url': 'https://lms.skillfactory.ru/outcome_service_handler'}" % key}
+    for key in (123, 1.5, True)
+] + [
+    # Дата в нестрогом формате, который принимает только strptime
+    {'lti_user_id': 'b' * 32, 'is_correct': None, 'attempt_type': 'run', 'created_at': '2023-4-1 1:2:3.5',
+     'passback_params': "{'oauth_consumer_key': 'sf', 'lis_result_sourcedid': 'course-v1:SkillFactory+DST-3.0:block', "
+                        "'lis_outcome_service_url': 'https://lms.skillfactory.ru/outcome_service_handler'}"}
+]
+
+# Замеряем оба COPY и возвращаем число строк, которые есть только в одной из таблиц.
+# К строкам добавляются записи из NON_STRING_PASSBACK_RECORDS
+def compare_copy_formats(db_config, rows, memory):
+    import psycopg2
+    edge_records = etl.RecordValidator(logging.getLogger('benchmark')).process_records(NON_STRING_PASSBACK_RECORDS)
+    assert len(edge_records) == len(NON_STRING_PASSBACK_RECORDS)
+    rows = rows + [record.as_row() for record in edge_records]
+    conn = psycopg2.connect(**db_config)
+    try:
+        cur = conn.cursor()
+        # measure может вызвать функцию дважды, поэтому каждая загрузка идет в свою таблицу
+        tables = {'csv': [], 'binary': []}
+
+        def copy(copy_format):
+            table = f"bench_copy_{copy_format}_{len(tables[copy_format])}"
+            tables[copy_format].append(table)
+            copy_to_temp_table(cur, table, rows, copy_format)
+
+        results = []
+        for copy_format in ('csv', 'binary'):
+            _, stats = measure(f'postgresql_copy_{copy_format}', lambda: copy(copy_format), len(rows), memory)
+            results.append(stats)
+
+        csv_table, binary_table = tables['csv'][0], tables['binary'][0]
+        cur.execute(f"""
+            SELECT (SELECT count(*) FROM (TABLE {csv_table} EXCEPT ALL TABLE {binary_table}) a)
+                 + (SELECT count(*) FROM (TABLE {binary_table} EXCEPT ALL TABLE {csv_table}) b)
+        """)
+        mismatches = cur.fetchone()[0]
+        conn.rollback()
+    finally:
+        conn.close()
+    results[-1]['mismatched_rows'] = mismatches
+    return results
+
+# ------------------------------------------------------
+# Замеры
+# ------------------------------------------------------
+
+# Запускаем этап дважды: без tracemalloc для времени и с ним для пиковой памяти
+def measure(stage, func, records, measure_memory=True):
+    started = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - started
+
+    peak_mb = None
+    if measure_memory:
+        tracemalloc.start()
+        func()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+
+    stats = {
+        'stage': stage,
+        'records': records,
+        'seconds': round(seconds, 4),
+        'records_per_s': round(records / seconds, 1) if seconds else None,
+        'peak_memory_mb': round(peak_mb, 2) if peak_mb is not None else None
+    }
+    print(f"{stage:<28} {seconds:>9.3f} s {stats['records_per_s'] or 0:>12.0f} rec/s "
+          f"{peak_mb if peak_mb is not None else float('nan'):>9.1f} MB")
+    return result, stats
+
+def run_benchmark(args):
+    logger = logging.getLogger('benchmark')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    end = datetime(2023, 4, 4, 12, 46, 47, 860798)
+    start = end - timedelta(days=args.days)
+    raw_records = generate_records(args.records, start, end, error_rate=args.error_rate,
+                                   users=args.users, passback_variants=args.passback_variants,
+                                   seed=args.seed)
+    params = {
+        'client': 'Benchmark',
+        'client_key': 'BENCH',
+        'start': start.strftime(DATE_FORMAT),
+        'end': end.strftime(DATE_FORMAT)
+    }
+    results = []
+    memory = not args.no_memory
+
+    with StubApiServer(raw_records, record_timestamps(args.records, start, end)) as server:
+        fetcher = etl.ApiFetcher(logger, api_url=server.url, window=timedelta(hours=args.window_hours),
+                                 max_workers=args.fetch_workers)
+        raw_data, stats = measure('fetch', lambda: fetcher.fetch(params), len(raw_records), memory)
+        stats['bytes'] = server.bytes_sent // (2 if memory else 1)
+        results.append(stats)
+
+        _, stats = measure('fetch_streaming', lambda: sum(1 for _ in fetcher.iter_records(params)),
+                           len(raw_records), memory)
+        results.append(stats)
+        fetcher.close()
+
+    def validate(workers):
+        validator = etl.RecordValidator(logger, batch_size=args.batch_size)
+        return validator.process_records(raw_data, workers=workers, chunk_size=args.chunk_size)
+
+    valid_records, stats = measure('validate', lambda: validate(1), len(raw_data), memory)
+    results.append(stats)
+
+    # Для сравнения: та же валидация по одной записи, без пачек (пачки должны быть не медленнее)
+    def validate_per_record():
+        validator = etl.RecordValidator(logger, batch_size=args.batch_size)
+        return [record for record in map(validator.process_record, raw_data) if record]
+
+    _, per_record_stats = measure('validate_per_record', validate_per_record, len(raw_data), memory)
+    results.append(per_record_stats)
+    if stats['seconds'] > per_record_stats['seconds']:
+        print(f"Валидация пачками медленнее, чем по одной записи: "
+              f"{stats['seconds']:.3f} с против {per_record_stats['seconds']:.3f} с")
+    if args.workers > 1:
+        _, stats = measure(f'validate_parallel_{args.workers}', lambda: validate(args.workers),
+                           len(raw_data), memory)
+        results.append(stats)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        _, stats = measure('save_to_csv', lambda: etl.save_to_csv(valid_records, 'bench.csv', tmp_dir),
+                           len(valid_records), memory)
+        results.append(stats)
+
+    rows = [record.as_row() for record in valid_records]
+    _, stats = measure('copy_encode_csv', lambda: sum(len(line) for line in etl.iter_csv_lines(rows)),
+                       len(rows), memory)
+    results.append(stats)
+    _, stats = measure('copy_encode_binary',
+                       lambda: sum(len(chunk) for chunk in etl.iter_binary_copy(rows, etl.BINARY_ENCODERS[False])),
+                       len(rows), memory)
+    results.append(stats)
+
+    if args.dsn:
+        db_config = json.loads(args.dsn) if args.dsn.startswith('{') else {'dsn': args.dsn}
+        copy_results = compare_copy_formats(db_config, rows, memory)
+        results.extend(copy_results)
+        if copy_results[-1]['mismatched_rows']:
+            print(f"Бинарный COPY расходится с текстовым: {copy_results[-1]['mismatched_rows']} строк")
+        _, stats = measure('postgresql_load', lambda: etl.load_records_to_postgresql(valid_records, db_config),
+                           len(valid_records), memory)
+        etl.close_postgres_loaders()
+        stats['target'] = 'postgresql'
+    else:
+        with mock.patch('psycopg2.connect', FakeConnection):
+            _, stats = measure('postgresql_load', lambda: etl.load_records_to_postgresql(valid_records, {}),
+                               len(valid_records), memory)
+            etl.close_postgres_loaders()
+        stats['target'] = 'fake_cursor'
+    results.append(stats)
+
+    return {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'valid_records': len(valid_records),
+        'stages': results
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк этапов загрузки данных Itresume")
+    parser.add_argument('--records', type=int, default=100000, help="число синтетических записей")
+    parser.add_argument('--error-rate', type=float, default=0.1, help="доля невалидных записей")
+    parser.add_argument('--days', type=int, default=3, help="длина интервала в днях")
+    parser.add_argument('--users', type=int, default=1000, help="число различных user_id")
+    parser.add_argument('--passback-variants', type=int, default=500,
+                        help="число различных строк passback_params")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--window-hours', type=float, default=12, help="размер окна скачивания")
+    parser.add_argument('--fetch-workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1, help="процессов для параллельной валидации")
+    parser.add_argument('--chunk-size', type=int, default=20000)
+    parser.add_argument('--dsn', help="строка подключения или JSON с параметрами локальной базы; "
+                                      "без нее используется фейковый курсор")
+    parser.add_argument('--no-memory', action='store_true', help="не замерять пиковую память")
+    parser.add_argument('--output', default='bench_results.json', help="файл для результатов")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
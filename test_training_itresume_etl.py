@@ -0,0 +1,376 @@
+"""
+Проверки согласованности путей валидации RecordValidator.
+
+По одной записи (process_record), пачками (process_batch) и в рабочих
+процессах (process_records(workers=N)) должны получаться одни и те же валидные
+записи, сообщения об ошибках и статистика. Быстрый разбор passback_params должен
+совпадать с ast.literal_eval.
+
+    python -m pytest -q test_training_itresume_etl.py
+"""
+
+import ast
+import json
+import logging
+import struct
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import benchmark_itresume_etl as bench
+import training_itresume_etl as etl
+
+logger = logging.getLogger('test')
+
+USER_ID = 'a' * 32
+PASSBACK = ("{'oauth_consumer_key': 'skillfactory', 'lis_result_sourcedid': 'course-v1:SkillFactory+DST-3.0', "
+            "'lis_outcome_service_url': 'https://lms.skillfactory.ru/courses/outcome_service_handler/'}")
+
+# Пограничные случаи, которые генератор бенчмарка не дает
+EDGE_RECORDS = [
+    # is_correct числом и строкой
+    {'lti_user_id': USER_ID, 'passback_params': PASSBACK, 'is_correct': 1, 'attempt_type': 'submit',
+     'created_at': '2023-04-01 10:00:00.000000'},
+    {'lti_user_id': USER_ID, 'passback_params': PASSBACK, 'is_correct': 'Yes', 'attempt_type': ' Submit ',
+     'created_at': '2023-04-01 10:00:00.000000'},
+    {'lti_user_id': USER_ID, 'passback_params': PASSBACK, 'is_correct': True, 'attempt_type': 'run',
+     'created_at': '2023-04-01 10:00:00.000000'},
+    # passback_params не в плоском формате: идет через literal_eval
+    {'lti_user_id': USER_ID, 'passback_params': PASSBACK.replace("'skillfactory'", "'sf' 'lms'"),
+     'is_correct': None, 'attempt_type': 'run', 'created_at': '2023-04-01 10:00:00.000000'},
+    {'lti_user_id': USER_ID, 'passback_params': PASSBACK.replace("'skillfactory'", "123"),
+     'is_correct': None, 'attempt_type': 'run', 'created_at': '2023-04-01 10:00:00.000000'},
+    {'lti_user_id': USER_ID, 'passback_params': '[1, 2]', 'is_correct': None, 'attempt_type': 'run',
+     'created_at': '2023-04-01 10:00:00.000000'},
+    # дата без микросекунд разбирается через strptime и не проходит
+    {'lti_user_id': USER_ID.upper(), 'passback_params': PASSBACK, 'is_correct': None, 'attempt_type': 'run',
+     'created_at': '2023-04-01 10:00:00'},
+    {},
+]
+
+
+def sample_records():
+    end = datetime(2023, 4, 4)
+    records = bench.generate_records(3000, end - timedelta(days=3), end, error_rate=0.3, seed=1)
+    return records + EDGE_RECORDS
+
+
+def validation_result(validator, valid_records):
+    return ([record.as_row() for record in valid_records], validator.errors, validator.statistics)
+
+
+def test_process_batch_matches_process_record():
+    records = sample_records()
+
+    per_record = etl.RecordValidator(logger)
+    valid_records = [record for record in map(per_record.process_record, records) if record]
+
+    batched = etl.RecordValidator(logger, batch_size=500)
+    batch_records = []
+    for batch in etl.iter_chunks(records, batched.batch_size):
+        batch_records.extend(batched.process_batch(batch))
+
+    assert validation_result(batched, batch_records) == validation_result(per_record, valid_records)
+    assert per_record.statistics['valid_records'] and per_record.statistics['invalid_records']
+
+
+def test_parallel_validation_matches_serial():
+    records = sample_records()
+
+    serial = etl.RecordValidator(logger, batch_size=500)
+    serial_records = serial.process_records(records)
+
+    parallel = etl.RecordValidator(logger, batch_size=500)
+    parallel_records = parallel.process_records(records, workers=2, chunk_size=700)
+
+    assert validation_result(parallel, parallel_records) == validation_result(serial, serial_records)
+
+
+def test_fast_passback_parser_matches_literal_eval():
+    validator = etl.RecordValidator(logger)
+    values = {record.get('passback_params') for record in sample_records()}
+    values.update([PASSBACK, "{}", "{'a': 'b',}", "{'a': \"b'c\"}", "{ 'a' : 'b' , 'c':'d' }"])
+
+    fast = [value for value in values
+            if isinstance(value, str) and validator.FLAT_DICT_PATTERN.fullmatch(value)]
+    assert len(fast) > 10
+    for value in fast:
+        assert validator.parse_passback_params(value) == (ast.literal_eval(value), None)
+
+
+# Нестроковые значения passback_params (после literal_eval) в записи становятся строками, как в CSV
+def test_passback_fields_are_strings():
+    validator = etl.RecordValidator(logger)
+    records = validator.process_records(bench.NON_STRING_PASSBACK_RECORDS[:3])
+
+    assert [record.oauth_consumer_key for record in records] == ['123', '1.5', 'True']
+    rows = [record.as_row() for record in records]
+    decoded = decode_binary_copy(b''.join(etl.iter_binary_copy(rows, etl.BINARY_ENCODERS[False])))
+    assert [row[1] for row in decoded] == [b'123', b'1.5', b'True']
+
+
+# Разбираем бинарный COPY обратно по полям: заголовок, кортежи (число полей, затем длина и байты
+# каждого поля, -1 - NULL) и -1 в конце
+def decode_binary_copy(data):
+    assert data.startswith(etl.BINARY_COPY_HEADER)
+    pos = len(etl.BINARY_COPY_HEADER)
+    rows = []
+    while True:
+        (field_count,) = struct.unpack_from('>h', data, pos)
+        pos += 2
+        if field_count == -1:
+            break
+        fields = []
+        for _ in range(field_count):
+            (length,) = struct.unpack_from('>i', data, pos)
+            pos += 4
+            if length == -1:
+                fields.append(None)
+            else:
+                fields.append(data[pos:pos + length])
+                pos += length
+        rows.append(fields)
+    assert pos == len(data)
+    return rows
+
+
+def pg_timestamp(value):
+    delta = datetime.strptime(value, etl.DATE_FORMAT) - etl.PG_EPOCH
+    return struct.pack('>q', (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def test_binary_copy_fields():
+    rows = [
+        (USER_ID, 'ключ', 'course-v1:sf', None, True, 'submit', '2023-04-01 10:00:00.500000'),
+        (USER_ID, '', 'course-v1:sf', 'https://lms/x', False, 'submit', '1999-12-31 23:59:59.999999'),
+        (USER_ID, None, None, None, None, 'run', '2000-01-01 00:00:00.000000'),
+    ]
+    decoded = decode_binary_copy(b''.join(etl.iter_binary_copy(rows, etl.BINARY_ENCODERS[False], chunk_bytes=16)))
+    assert decoded == [
+        [USER_ID.encode(), 'ключ'.encode('utf-8'), b'course-v1:sf', None, b'\x01', b'submit',
+         pg_timestamp(rows[0][6])],
+        [USER_ID.encode(), None, b'course-v1:sf', b'https://lms/x', b'\x00', b'submit', pg_timestamp(rows[1][6])],
+        [USER_ID.encode(), None, None, None, None, b'run', b'\x00' * 8],
+    ]
+
+    user_id = str(uuid.UUID(USER_ID))
+    compact_rows = [(user_id, 7, 'course-v1:sf', None, True, 'run', '2023-04-01 10:00:00.000000')]
+    decoded = decode_binary_copy(b''.join(etl.iter_binary_copy(compact_rows, etl.BINARY_ENCODERS[True])))
+    assert decoded == [[uuid.UUID(USER_ID).bytes, struct.pack('>i', 7), b'course-v1:sf', None, b'\x01', b'run',
+                        pg_timestamp(compact_rows[0][6])]]
+
+
+# Дату, которую принимает только strptime, валидатор приводит к DATE_FORMAT, и бинарный COPY ее кодирует
+def test_lenient_date_is_normalized():
+    record = dict(EDGE_RECORDS[0], created_at='2023-4-1 1:2:3.5')
+    [valid_record] = etl.RecordValidator(logger).process_records([record])
+
+    assert valid_record.created_at == '2023-04-01 01:02:03.500000'
+    [row] = decode_binary_copy(b''.join(etl.iter_binary_copy([valid_record.as_row()], etl.BINARY_ENCODERS[False])))
+    assert row[6] == pg_timestamp('2023-04-01 01:02:03.500000')
+
+
+# Та же дата в колоночной выгрузке: Arrow приводит created_at к timestamp без ошибки
+def test_lenient_date_in_columnar_export(tmp_path):
+    pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    records = [dict(EDGE_RECORDS[0], created_at='2023-4-1 1:2:3.5'), EDGE_RECORDS[0]]
+    valid_records = etl.RecordValidator(logger).process_records(records)
+
+    table = etl.records_to_arrow_table(valid_records, partition_by_date=True)
+    assert table.column('created_at').to_pylist() == [datetime(2023, 4, 1, 1, 2, 3, 500000),
+                                                      datetime(2023, 4, 1, 10, 0)]
+    assert table.column('created_date').to_pylist() == [datetime(2023, 4, 1).date()] * 2
+
+    target, _ = etl.save_to_columnar(valid_records, 'parquet', custom_path=tmp_path)
+    assert pq.read_table(target).column('created_at').to_pylist()[0] == datetime(2023, 4, 1, 1, 2, 3, 500000)
+
+
+# Ответ API кусками, как requests при stream=True
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def get(self, url, params=None, timeout=None, stream=False):
+        return FakeResponse(self.chunks)
+
+
+# Хвост ответа после ']' пришел отдельным куском: окно все равно попадает в кэш
+def test_window_cached_when_tail_arrives_in_next_chunk(tmp_path):
+    params = {'client': 'test', 'client_key': 'key', 'start': '2023-04-01 00:00:00.000000',
+              'end': '2023-04-01 11:59:59.999999'}
+    cache = etl.ResponseCache(tmp_path)
+    fetcher = etl.ApiFetcher(logger, cache=cache, session=FakeSession([b'[{"a":1}]', b'\n']))
+
+    assert list(fetcher.iter_records(params)) == [{'a': 1}]
+    path = cache.get(params, params['start'], params['end'])
+    assert path is not None and cache.read(path) == b'[{"a":1}]\n'
+
+
+# Потоковый разбор JSON-массива: результат не должен зависеть от границ кусков
+def parse_chunks(chunks):
+    return list(etl.iter_json_array(chunks))
+
+
+def test_with_final_flag():
+    assert list(etl._with_final_flag([])) == [(b'', True)]
+    assert list(etl._with_final_flag([b'a', b'b'])) == [(b'a', False), (b'b', True)]
+
+
+def test_json_array_numbers_split_across_chunks():
+    assert parse_chunks([b'[12', b'34, 5', b'.5e', b'1, -', b'7', b']']) == [1234, 55.0, -7]
+    assert parse_chunks([b'[1', b'0]']) == [10]
+
+
+# Документ, разрезанный по одному байту, в том числе внутри многобайтных символов UTF-8
+def test_json_array_split_byte_by_byte():
+    data = [{'name': 'Привет, мир €', 'emoji': '😀', 'n': 123456, 'x': -1.25e-3, 'ok': True, 'none': None},
+            'строка', 42, [1, [2, {}]]]
+    raw = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    assert parse_chunks([raw[i:i + 1] for i in range(len(raw))]) == data
+    assert parse_chunks([raw[:3], raw[3:]]) == data
+
+
+def test_json_array_empty():
+    assert parse_chunks([b'[]']) == []
+    assert parse_chunks([b' [', b' ', b'] ', b'\n']) == []
+
+
+def test_json_array_truncated():
+    for chunks in ([], [b''], [b'['], [b'[{"a": 1}, {"b":'], [b'[1, 2'], ['[1, "стр'.encode('utf-8')[:-1]]):
+        with pytest.raises(ValueError):
+            parse_chunks(chunks)
+
+
+def test_json_array_trailing_data():
+    assert parse_chunks([b'[1]', b' \r\n', b'']) == [1]
+    for chunks in ([b'[1] garbage'], [b'[1]', b' x'], [b'[1]]'], [b'[1][2]']):
+        with pytest.raises(ValueError):
+            parse_chunks(chunks)
+
+
+def test_json_array_not_array():
+    with pytest.raises(ValueError):
+        parse_chunks([b'{"a": 1}'])
+
+
+# План дозагрузки: завершенные интервалы, размер окна и их сохранение между запусками
+def make_planner(tmp_path, client='test', **kwargs):
+    return etl.BackfillPlanner(tmp_path / 'backfill.json', client, '2023-04-01 00:00:00.000000',
+                               '2023-04-02 23:59:59.999999', initial_window=timedelta(hours=12), **kwargs)
+
+
+def dt(value):
+    return datetime.strptime(value, etl.DATE_FORMAT)
+
+
+def test_backfill_missing_ranges_after_partial_completion(tmp_path):
+    planner = make_planner(tmp_path)
+    assert planner.missing_ranges() == [(planner.start, planner.end)]
+    assert planner.next_window() == ('2023-04-01 00:00:00.000000', '2023-04-01 11:59:59.999999')
+
+    planner.record('2023-04-01 00:00:00.000000', '2023-04-01 11:59:59.999999', 50000, 60)
+    planner.record('2023-04-02 00:00:00.000000', '2023-04-02 05:59:59.999999', 50000, 60)
+    missing = [(dt('2023-04-01 12:00:00.000000'), dt('2023-04-01 23:59:59.999999')),
+               (dt('2023-04-02 06:00:00.000000'), dt('2023-04-02 23:59:59.999999'))]
+    assert planner.missing_ranges() == missing
+
+    # Следующий запуск продолжает с сохраненного места
+    resumed = make_planner(tmp_path)
+    assert resumed.missing_ranges() == missing
+    assert resumed.next_window() == ('2023-04-01 12:00:00.000000', '2023-04-01 23:59:59.999999')
+
+    resumed.record('2023-04-01 12:00:00.000000', '2023-04-01 23:59:59.999999', 50000, 60)
+    resumed.record('2023-04-02 06:00:00.000000', '2023-04-02 23:59:59.999999', 50000, 60)
+    assert resumed.missing_ranges() == [] and resumed.next_window() is None
+    assert resumed.completed == [(resumed.start, resumed.end)]
+
+
+def test_backfill_merges_adjacent_intervals(tmp_path):
+    planner = make_planner(tmp_path)
+    planner._add_completed(dt('2023-04-01 06:00:00.000000'), dt('2023-04-01 08:59:59.999999'))
+    planner._add_completed(dt('2023-04-01 00:00:00.000000'), dt('2023-04-01 02:59:59.999999'))
+    # Вплотную к предыдущему (следующая микросекунда) - склеивается
+    planner._add_completed(dt('2023-04-01 03:00:00.000000'), dt('2023-04-01 03:59:59.999999'))
+    assert planner.completed == [(dt('2023-04-01 00:00:00.000000'), dt('2023-04-01 03:59:59.999999')),
+                                 (dt('2023-04-01 06:00:00.000000'), dt('2023-04-01 08:59:59.999999'))]
+
+    # Пересекающийся интервал закрывает промежуток и склеивает оба
+    planner._add_completed(dt('2023-04-01 03:30:00.000000'), dt('2023-04-01 07:00:00.000000'))
+    assert planner.completed == [(dt('2023-04-01 00:00:00.000000'), dt('2023-04-01 08:59:59.999999'))]
+
+
+def test_backfill_window_clamped_to_limits(tmp_path):
+    planner = make_planner(tmp_path, target_records=1000, target_seconds=0, min_window=timedelta(minutes=5),
+                           max_window=timedelta(days=1))
+    # Пустое окно растет не больше чем в max_growth раз, но не больше max_window
+    planner.record('2023-04-01 00:00:00.000000', '2023-04-01 02:59:59.999999', 0, 1)
+    assert planner.window == timedelta(hours=12)
+    planner.record('2023-04-01 03:00:00.000000', '2023-04-01 14:59:59.999999', 0, 1)
+    assert planner.window == timedelta(days=1)
+
+    # Очень плотное окно уменьшается до min_window, а не до нуля
+    planner.record('2023-04-01 15:00:00.000000', '2023-04-01 15:59:59.999999', 10 ** 6, 1)
+    assert planner.window == timedelta(minutes=5)
+
+    # Медленный ответ тоже уменьшает окно
+    slow = make_planner(tmp_path, client='slow', target_seconds=60)
+    slow.record('2023-04-01 00:00:00.000000', '2023-04-01 11:59:59.999999', 10, 120)
+    assert slow.window == timedelta(hours=6)
+
+
+def test_backfill_truncated_window_does_not_shrink(tmp_path):
+    planner = make_planner(tmp_path, target_records=1000, target_seconds=0)
+    # Окно обрезано концом промежутка до часа, записей мало: размер 12 часов сохраняется
+    planner.record('2023-04-01 00:00:00.000000', '2023-04-01 00:59:59.999999', 10, 1)
+    assert planner.window == timedelta(hours=12)
+
+    # Обрезанное, но плотное окно уменьшает размер
+    planner.record('2023-04-01 01:00:00.000000', '2023-04-01 01:59:59.999999', 2000, 1)
+    assert planner.window == timedelta(minutes=30)
+
+
+def test_backfill_shrink_stops_at_min_window(tmp_path):
+    planner = make_planner(tmp_path, min_window=timedelta(minutes=5))
+    assert planner.shrink('2023-04-01 00:00:00.000000', '2023-04-01 11:59:59.999999')
+    assert planner.window == timedelta(hours=6)
+    assert make_planner(tmp_path).window == timedelta(hours=6)
+
+    assert planner.shrink('2023-04-01 00:00:00.000000', '2023-04-01 00:07:59.999999')
+    assert planner.window == timedelta(minutes=5)
+    assert not planner.shrink('2023-04-01 00:00:00.000000', '2023-04-01 00:04:59.999999')
+    assert planner.window == timedelta(minutes=5)
+    assert planner.missing_ranges() == [(planner.start, planner.end)]
+
+
+# Метки из --clients-file экранируются по текстовому формату Prometheus
+def test_prometheus_label_values_escaped(tmp_path):
+    client = 'school "A"\\backslash\nnext'
+    metrics = etl.PipelineMetrics(labels={'client': client})
+    metrics.add('fetch', 1.5, records=10, bytes=100)
+    metrics.increment('api_retries')
+    metrics.success = True
+    target = tmp_path / 'metrics.prom'
+    metrics.write_prometheus(target)
+
+    escaped = 'client="school \\"A\\"\\\\backslash\\nnext"'
+    samples = [line for line in target.read_text(encoding='utf-8').splitlines() if not line.startswith('#')]
+    assert samples and all(escaped in line for line in samples)
+    assert f'itresume_etl_stage_records{{stage="fetch",{escaped}}} 10' in samples
+    assert f'itresume_etl_api_retries_total{{{escaped}}} 1' in samples
@@ -6,23 +6,49 @@
 2. Валидацию полученных данных
 3. Сохранение в базу PostgreSQL
 
+Импорт модуля ничего не запускает: RecordValidator и остальные части можно
+использовать отдельно. requests и psycopg2 импортируются только при первом
+обращении к сети или базе. Запуск всего процесса:
+
+    python training_itresume_etl.py --start "2023-04-01 00:00:00.000000" --end "2023-04-02 00:00:00.000000"
+
+Регулярная загрузка с последнего сохраненного watermark до текущего момента:
+
+    python training_itresume_etl.py --incremental
+
+Несколько клиентов API в одном процессе (общие HTTP-сессия и пул соединений к базе):
+
+    python training_itresume_etl.py --clients-file clients.json --fetch-workers 8 --incremental
+
 Author: Guzel
 Date: 23.02.2026
 Version: 1.0
 """
 
-import requests
+import argparse
 import ast
+import codecs
+import gzip
+import hashlib
+import json
 from typing import Dict, List, Tuple, Any, Optional
 import re
+import struct
 from datetime import datetime, timedelta
 import csv
-import psycopg2
-from psycopg2 import sql
+import io
 import os
+import sys
 import logging
 from pathlib import Path
 import time
+import threading
+import queue
+import cProfile
+import pstats
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # Параметры для скачивания данных
 API_URL = "https://b2b.itresume.ru/api/statistics"
@@ -61,14 +87,15 @@ def create_project_directories(base_path=None, project_name="my_project"):
     logs_path.mkdir(exist_ok=True)
 
     return base_path
-project_root = create_project_directories(BASE_PATH, PROJECT_NAME)
-log_dir = project_root / 'logs' 
+
+# Папка проекта по умолчанию, создается при запуске main()
+project_root = Path(BASE_PATH) / PROJECT_NAME
 
 # ------------------------------------------------------
 # Создаем систему логирования.
 # ------------------------------------------------------
 
-def setup_logging():
+def setup_logging(log_dir):
            
     # Текущая дата для имени файла
     current_date = datetime.now().strftime("%Y-%m-%d")
@@ -109,46 +136,868 @@ def cleanup_old_logs(log_dir, days_to_keep=3):    # Удаление стары
             except ValueError:
                 continue
 
-# Инициализация логирования при импорте модуля
-logger = setup_logging()
+# Обработчики логгера настраиваются в main(), при импорте логгер ничего не пишет
+logger = logging.getLogger('logger')
+
+# ------------------------------------------------------
+# Метрики этапов и профилирование
+# ------------------------------------------------------
+
+# Время, число записей, байты и пиковая память по этапам (fetch, parse, validate, csv, export,
+# copy, dedup, commit) и счетчики (повторы запросов, попадания в кэш). Потокобезопасно
+class PipelineMetrics:
+    STAGES = ['fetch', 'parse', 'validate', 'csv', 'export', 'copy', 'dedup', 'commit']
+    # fetch и parse идут по окнам в нескольких потоках через add(), поэтому профилировать их нечем
+    PROFILED_STAGES = ['validate', 'csv', 'export', 'copy', 'dedup', 'commit']
+
+    def __init__(self, labels: Optional[Dict] = None, profile_stage: Optional[str] = None,
+                 profile_dir=None):
+        self.labels = labels or {}
+        self.profile_stage = profile_stage
+        self.profile_dir = Path(profile_dir) if profile_dir else Path.cwd()
+        self.started_at = datetime.now()
+        self.stages = {}
+        self.counters = {}
+        self.success = None
+        self._lock = threading.Lock()
+
+    # Добавляем к этапу время, записи и байты (можно вызывать многократно, например из потоков)
+    def add(self, stage: str, seconds: float = 0.0, records: int = 0, bytes: int = 0):
+        with self._lock:
+            metrics = self.stages.setdefault(stage, {'seconds': 0.0, 'records': 0, 'bytes': 0,
+                                                     'peak_rss_bytes': None})
+            metrics['seconds'] += seconds
+            metrics['records'] += records
+            metrics['bytes'] += bytes
+            metrics['peak_rss_bytes'] = peak_rss_bytes()
+
+    def increment(self, counter: str, value: int = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    # Замер блока кода: with metrics.stage('validate') as stage: ...; stage['records'] = n
+    @contextmanager
+    def stage(self, name: str):
+        measured = {'records': 0, 'bytes': 0}
+        profiler = None
+        if name == self.profile_stage:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        started = time.perf_counter()
+        try:
+            yield measured
+        finally:
+            seconds = time.perf_counter() - started
+            if profiler is not None:
+                profiler.disable()
+                self._dump_profile(name, profiler)
+            self.add(name, seconds, measured['records'], measured['bytes'])
+
+    def _dump_profile(self, name, profiler):
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        profile_file = self.profile_dir / f"profile_{name}.prof"
+        profiler.dump_stats(profile_file)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(20)
+        logger.info(f"Профиль этапа {name} сохранен в {profile_file}\n{report.getvalue()}")
+
+    def summary(self) -> Dict:
+        stages = {}
+        for name, metrics in self.stages.items():
+            seconds = metrics['seconds']
+            stages[name] = dict(metrics, records_per_s=metrics['records'] / seconds if seconds else None)
+        return {
+            'labels': self.labels,
+            'started_at': self.started_at.strftime(DATE_FORMAT),
+            'duration_seconds': (datetime.now() - self.started_at).total_seconds(),
+            'success': self.success,
+            'stages': stages,
+            'counters': dict(self.counters),
+            'peak_rss_bytes': peak_rss_bytes()
+        }
+
+    def write_json(self, file_path):
+        _atomic_write(file_path, json.dumps(self.summary(), ensure_ascii=False, indent=2))
+
+    # Формат textfile collector для node_exporter
+    def write_prometheus(self, file_path, prefix='itresume_etl'):
+        summary = self.summary()
+        base_labels = ''.join(f',{key}="{_prometheus_label_value(value)}"' for key, value in self.labels.items())
+        plain_labels = '{' + base_labels.lstrip(',') + '}' if base_labels else ''
+        lines = []
+
+        stage_metrics = [
+            ('stage_seconds', 'seconds', 'Wall time of the stage'),
+            ('stage_records', 'records', 'Records processed by the stage'),
+            ('stage_records_per_second', 'records_per_s', 'Stage throughput'),
+            ('stage_bytes', 'bytes', 'Bytes transferred by the stage'),
+            ('stage_peak_rss_bytes', 'peak_rss_bytes', 'Process peak RSS after the stage'),
+        ]
+        for metric, key, help_text in stage_metrics:
+            lines.append(f"# HELP {prefix}_{metric} {help_text}")
+            lines.append(f"# TYPE {prefix}_{metric} gauge")
+            for name, metrics in summary['stages'].items():
+                if metrics[key] is not None:
+                    lines.append(f'{prefix}_{metric}{{stage="{_prometheus_label_value(name)}"{base_labels}}} '
+                                 f'{metrics[key]}')
+
+        for counter, value in summary['counters'].items():
+            lines.append(f"# TYPE {prefix}_{counter}_total counter")
+            lines.append(f"{prefix}_{counter}_total{plain_labels} {value}")
+
+        lines.append(f"# TYPE {prefix}_last_run_duration_seconds gauge")
+        lines.append(f"{prefix}_last_run_duration_seconds{plain_labels} {summary['duration_seconds']}")
+        lines.append(f"# TYPE {prefix}_last_run_success gauge")
+        lines.append(f"{prefix}_last_run_success{plain_labels} {int(bool(self.success))}")
+        lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{prefix}_last_run_timestamp_seconds{plain_labels} {time.time():.0f}")
+        _atomic_write(file_path, '\n'.join(lines) + '\n')
+
+
+# Значение метки в текстовом формате Prometheus: экранируем обратную косую черту, кавычку
+# и перевод строки. Имена клиентов приходят из --clients-file и могут содержать что угодно
+def _prometheus_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Пиковое потребление памяти процессом (на Windows модуля resource нет)
+def peak_rss_bytes() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS - байты
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+def _atomic_write(file_path, text: str):
+    file_path = Path(file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = file_path.with_name(file_path.name + '.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_file, file_path)
 
 # ------------------------------------------------------
 # Создаем подключение и выгружаем данные в питон-формат
 # ------------------------------------------------------
-logger.info("===============================================")
-logger.info("Начинаем скачивание данных из API...")
 
-try:
-    r = requests.get(API_URL, params=params)
-    logger.info(f"Статус ответа API: {r.status_code}")
-    
-    if r.status_code != 200:
-        logger.error(f"Ошибка доступа к API. Status code: {r.status_code}")
-        raise Exception(f"API request failed with status {r.status_code}")
-    
-    raw_data = r.json()
-    logger.info(f"Данные успешно загружены. Получено записей: {len(raw_data)}")
-    
-except Exception as e:
-    logger.error(f"Неожиданная ошибка при загрузке данных: {str(e)}")
-    raise
+# Параметры параллельного скачивания: размер окна, число одновременных запросов и повторы
+FETCH_CONFIG = {
+    'window': timedelta(hours=12),
+    'max_workers': 4,
+    'max_retries': 5,
+    'backoff_factor': 1.0,
+    'timeout': 300
+}
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Потоковый разбор ответа API вместо загрузки всего JSON в память
+STREAMING = True
+
+
+class ApiFetcher:
+    # Коды ответа, при которых запрос имеет смысл повторить
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, logger, api_url=API_URL, window=timedelta(hours=12), max_workers=4,
+                 max_retries=5, backoff_factor=1.0, timeout=300, metrics=None, cache=None, replay=False,
+                 session=None):
+        self.logger = logger
+        self.metrics = metrics or PipelineMetrics()
+        self.api_url = api_url
+        self.window = window
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.cache = cache
+        # В режиме replay данные читаются только из кэша, сеть не нужна
+        self.replay = replay
+        self.session = None
+        # Общую сессию (несколько клиентов в одном процессе) закрывает ее владелец
+        self._owns_session = session is None
+        if replay:
+            if cache is None:
+                raise ValueError("Для режима replay нужен кэш ответов API")
+            return
+        if session is not None:
+            self.session = session
+            return
+
+        # requests импортируем только когда действительно нужна сеть
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # Одна keep-alive сессия на все окна, пул соединений по числу потоков
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    # Разбиваем интервал start-end на последовательные непересекающиеся окна
+    def split_range(self, start: str, end: str) -> List[Tuple[str, str]]:
+        start_dt = datetime.strptime(start, DATE_FORMAT)
+        end_dt = datetime.strptime(end, DATE_FORMAT)
+
+        windows = []
+        window_start = start_dt
+        while window_start < end_dt:
+            next_start = min(window_start + self.window, end_dt)
+            # Конец окна на микросекунду раньше начала следующего, чтобы границы не дублировались
+            window_end = next_start if next_start == end_dt else next_start - timedelta(microseconds=1)
+            windows.append((window_start.strftime(DATE_FORMAT), window_end.strftime(DATE_FORMAT)))
+            window_start = next_start
+        return windows
+
+    # Окна для скачивания; в режиме replay - окна, которые есть в кэше
+    def windows(self, params: Dict) -> List[Tuple[str, str]]:
+        if self.replay:
+            windows = self.cache.list_windows(params, params['start'], params['end'])
+            self.logger.info(f"Режим replay: в кэше найдено окон {len(windows)}")
+            return windows
+        return self.split_range(params['start'], params['end'])
+
+    def _cached_window(self, params: Dict, start: str, end: str) -> Optional[Path]:
+        if self.cache is None:
+            return None
+        path = self.cache.get(params, start, end)
+        if path is not None:
+            self.metrics.increment('api_cache_hits')
+            return path
+        if self.replay:
+            raise Exception(f"Окна {start} - {end} нет в кэше, а в режиме replay сеть не используется")
+        self.metrics.increment('api_cache_misses')
+        return None
+
+    def _should_cache(self, end: str) -> bool:
+        return self.cache is not None and self.cache.is_settled(end)
+
+    # Сырые байты ответа за окно кусками: из кэша или из сети (с записью в кэш по пути)
+    def iter_window_chunks(self, params: Dict, start: str, end: str, chunk_size: int = 64 * 1024):
+        cached = self._cached_window(params, start, end)
+        if cached is not None:
+            yield from self.cache.iter_chunks(cached, chunk_size)
+            return
+
+        r = self.request_window(params, start, end, stream=True)
+        writer = self.cache.writer(params, start, end) if self._should_cache(end) else None
+        try:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if writer is not None:
+                    writer.write(chunk)
+                yield chunk
+            if writer is not None:
+                writer.commit()
+                writer = None
+        finally:
+            r.close()
+            if writer is not None:
+                writer.discard()
+
+    # Выполняем запрос одного окна с повторами при 429 и 5xx
+    def request_window(self, params: Dict, start: str, end: str, stream: bool = False):
+        import requests
+        window_params = dict(params, start=start, end=end)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                r = self.session.get(self.api_url, params=window_params, timeout=self.timeout,
+                                     stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                self.metrics.increment('api_retries')
+                self.logger.warning(f"Окно {start} - {end}: ошибка соединения ({e}), повтор {attempt + 1}")
+                time.sleep(self.backoff_factor * 2 ** attempt)
+                continue
+
+            if r.status_code == 200:
+                return r
+
+            r.close()
+            if r.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                # Учитываем Retry-After, если сервер его прислал
+                retry_after = r.headers.get('Retry-After')
+                delay = float(retry_after) if retry_after and retry_after.isdigit() \
+                    else self.backoff_factor * 2 ** attempt
+                self.metrics.increment('api_retries')
+                self.logger.warning(f"Окно {start} - {end}: статус {r.status_code}, "
+                                    f"повтор {attempt + 1} через {delay:.1f} с")
+                time.sleep(delay)
+                continue
+
+            self.logger.error(f"Ошибка доступа к API. Status code: {r.status_code}")
+            raise Exception(f"API request failed with status {r.status_code}")
+
+    # Скачиваем одно окно целиком
+    def fetch_window(self, params: Dict, start: str, end: str) -> List[Dict]:
+        started = time.perf_counter()
+        cached = self._cached_window(params, start, end)
+        if cached is not None:
+            content = self.cache.read(cached)
+        else:
+            r = self.request_window(params, start, end)
+            content = r.content
+            if self._should_cache(end):
+                self.cache.store(params, start, end, content)
+        self.metrics.add('fetch', time.perf_counter() - started, bytes=len(content))
+
+        started = time.perf_counter()
+        window_data = json.loads(content)
+        self.metrics.add('parse', time.perf_counter() - started, records=len(window_data))
+        return window_data
+
+    # Скачиваем все окна параллельно и склеиваем результат в исходном порядке
+    def fetch(self, params: Dict) -> List[Dict]:
+        windows = self.windows(params)
+        self.logger.info(f"Интервал разбит на {len(windows)} окон, потоков: {self.max_workers}")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.fetch_window, params, start, end) for start, end in windows]
+
+            raw_data = []
+            try:
+                for (start, end), future in zip(windows, futures):
+                    window_data = future.result()
+                    self.logger.info(f"Окно {start} - {end}: получено записей {len(window_data)}")
+                    raw_data.extend(window_data)
+            except BaseException:
+                # При первой ошибке отменяем окна, которые еще стоят в очереди, и не ждем их скачивания
+                executor.shutdown(cancel_futures=True)
+                raise
+        return raw_data
+
+    # Потоковый режим: до max_workers окон качаются и разбираются одновременно, каждое в свою
+    # ограниченную очередь, а записи отдаются по одной строго в порядке окон.
+    # Память ограничена: не больше max_workers * queue_size пачек по batch_size записей
+    def iter_records(self, params: Dict, chunk_size: int = 64 * 1024, batch_size: int = 1000,
+                     queue_size: int = 8):
+        windows = iter(self.windows(params))
+        stop = threading.Event()
+        in_flight = deque()
+
+        def submit_next():
+            for start, end in windows:
+                window_queue = queue.Queue(maxsize=queue_size)
+                future = executor.submit(self._stream_window, params, start, end, window_queue, stop,
+                                         chunk_size, batch_size)
+                in_flight.append((start, end, window_queue, future))
+                return
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            for _ in range(self.max_workers):
+                submit_next()
+            while in_flight:
+                start, end, window_queue, future = in_flight[0]
+                count = 0
+                while True:
+                    batch = window_queue.get()
+                    if batch is None:
+                        break
+                    count += len(batch)
+                    yield from batch
+                # Ошибка окна поднимается здесь, после уже отданных записей этого окна
+                future.result()
+                in_flight.popleft()
+                self.logger.info(f"Окно {start} - {end}: получено записей {count}")
+                submit_next()
+        finally:
+            # Генератор закрыли раньше времени или окно упало: останавливаем остальные окна
+            stop.set()
+            executor.shutdown(cancel_futures=True)
+
+    # Одно окно в потоке: читаем ответ кусками, разбираем и кладем записи пачками в очередь.
+    # В конце (в том числе при ошибке) кладем None. Время ожидания места в очереди в fetch не входит
+    def _stream_window(self, params: Dict, start: str, end: str, window_queue, stop, chunk_size: int,
+                       batch_size: int):
+        started = time.perf_counter()
+        chunks = self.iter_window_chunks(params, start, end, chunk_size)
+        count = 0
+        elapsed = 0.0
+        received = {'bytes': 0}
+
+        def counted_chunks():
+            for chunk in chunks:
+                received['bytes'] += len(chunk)
+                yield chunk
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    window_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for batch in iter_chunks(iter_json_array(counted_chunks()), batch_size):
+                count += len(batch)
+                elapsed += time.perf_counter() - started
+                if not put(batch):
+                    return
+                started = time.perf_counter()
+            elapsed += time.perf_counter() - started
+        finally:
+            chunks.close()
+            self.metrics.add('fetch', elapsed, records=count, bytes=received['bytes'])
+            put(None)
+
+    # Потоковый режим пачками фиксированного размера
+    def iter_batches(self, params: Dict, batch_size: int = 5000):
+        return iter_chunks(self.iter_records(params), batch_size)
+
+    def close(self):
+        if self.session is not None and self._owns_session:
+            self.session.close()
+        if self.cache is not None and not self.replay:
+            self.cache.evict()
+
+
+# Инкрементально разбираем JSON-массив из потока байтовых кусков и отдаем элементы по одному
+def iter_json_array(chunks):
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    whitespace = ' \t\n\r'
+    buffer = ''
+    pos = 0
+    started = False
+    finished = False
+
+    for chunk, final in _with_final_flag(chunks):
+        text = utf8_decoder.decode(chunk, final) if isinstance(chunk, bytes) else chunk
+        buffer = buffer[pos:] + text
+        pos = 0
+
+        while True:
+            while pos < len(buffer) and buffer[pos] in whitespace:
+                pos += 1
+            if pos >= len(buffer):
+                break
+
+            if finished:
+                raise ValueError(f"Unexpected data after JSON array: {buffer[pos:pos + 20]!r}")
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError(f"Expected JSON array, got: {buffer[pos:pos + 20]!r}")
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == ',':
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                # Дочитываем поток до конца: после массива допустимы только пробельные символы,
+                # а iter_window_chunks записывает окно в кэш, только когда куски закончились
+                finished = True
+                pos += 1
+                continue
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                # Элемент еще не докачан целиком, ждем следующий кусок
+                break
+            # Число в конце буфера может продолжиться в следующем куске
+            if not final and isinstance(item, (int, float)) and \
+                    (end == len(buffer) or buffer[end] not in whitespace + ',]'):
+                break
+            yield item
+            pos = end
+
+    if not finished:
+        raise ValueError("Unexpected end of JSON array")
+
+
+# Нарезаем любой итерируемый объект на списки фиксированного размера
+def iter_chunks(iterable, size: int):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _with_final_flag(chunks):
+    previous = None
+    has_previous = False
+    for chunk in chunks:
+        if has_previous:
+            yield previous, False
+        previous = chunk
+        has_previous = True
+    yield (previous if has_previous else b''), True
+
+
+# ------------------------------------------------------
+# Кэш сырых ответов API на диске
+# ------------------------------------------------------
+
+# Исторические окна не меняются, поэтому ответ за окно можно сохранить и переиспользовать:
+# повторный запуск, отладка и смена правил валидации не требуют скачивания заново.
+# Свежие окна (конец позже now - settle) не кэшируются: в них еще могут прийти записи
+API_CACHE = False
+CACHE_CONFIG = {
+    'max_bytes': 2 * 1024 ** 3,
+    'max_age': timedelta(days=90),
+    'settle': timedelta(hours=1),
+}
+
+# Файлы: <cache_dir>/<client>/<sha256(client_key)[:16]>/<start>__<end>.json.gz
+class ResponseCache:
+    FILE_DATE_FORMAT = '%Y%m%dT%H%M%S%f'
+    SUFFIX = '.json.gz'
+
+    def __init__(self, cache_dir, max_bytes=CACHE_CONFIG['max_bytes'], max_age=CACHE_CONFIG['max_age'],
+                 settle=CACHE_CONFIG['settle'], compresslevel=6):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.settle = settle
+        self.compresslevel = compresslevel
+
+    def client_dir(self, params: Dict) -> Path:
+        client = re.sub(r'[^\w.-]', '_', str(params['client']))
+        key_hash = hashlib.sha256(str(params['client_key']).encode('utf-8')).hexdigest()[:16]
+        return self.cache_dir / client / key_hash
+
+    def path(self, params: Dict, start: str, end: str) -> Path:
+        start_dt = datetime.strptime(start, DATE_FORMAT)
+        end_dt = datetime.strptime(end, DATE_FORMAT)
+        name = f"{start_dt.strftime(self.FILE_DATE_FORMAT)}__{end_dt.strftime(self.FILE_DATE_FORMAT)}"
+        return self.client_dir(params) / (name + self.SUFFIX)
+
+    # Кэшируем только окна, которые уже не изменятся
+    def is_settled(self, end: str) -> bool:
+        return datetime.strptime(end, DATE_FORMAT) <= datetime.now() - self.settle
+
+    def get(self, params: Dict, start: str, end: str) -> Optional[Path]:
+        path = self.path(params, start, end)
+        return path if path.exists() else None
+
+    def iter_chunks(self, path: Path, chunk_size: int = 64 * 1024):
+        with gzip.open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def read(self, path: Path) -> bytes:
+        with gzip.open(path, 'rb') as f:
+            return f.read()
+
+    def writer(self, params: Dict, start: str, end: str):
+        return ResponseCacheWriter(self.path(params, start, end), self.compresslevel)
+
+    def store(self, params: Dict, start: str, end: str, content: bytes):
+        writer = self.writer(params, start, end)
+        try:
+            writer.write(content)
+            writer.commit()
+        except BaseException:
+            writer.discard()
+            raise
+
+    # Окна из кэша, целиком лежащие внутри start-end, по порядку (для --replay)
+    def list_windows(self, params: Dict, start: str, end: str) -> List[Tuple[str, str]]:
+        start_dt = datetime.strptime(start, DATE_FORMAT)
+        end_dt = datetime.strptime(end, DATE_FORMAT)
+        client_dir = self.client_dir(params)
+        if not client_dir.exists():
+            return []
+
+        windows = []
+        for path in client_dir.glob('*' + self.SUFFIX):
+            try:
+                window_start, window_end = (datetime.strptime(part, self.FILE_DATE_FORMAT) for part in
+                                            path.name[:-len(self.SUFFIX)].split('__'))
+            except ValueError:
+                continue
+            if start_dt <= window_start and window_end <= end_dt:
+                windows.append((window_start, window_end))
+            elif window_start <= end_dt and window_end >= start_dt:
+                logger.warning(f"Окно кэша {path.name} выходит за границы периода и пропущено")
+        return [(window_start.strftime(DATE_FORMAT), window_end.strftime(DATE_FORMAT))
+                for window_start, window_end in sorted(windows)]
+
+    # Удаляем файлы старше max_age, затем самые старые, пока кэш не уложится в max_bytes
+    def evict(self) -> int:
+        if not self.cache_dir.exists():
+            return 0
+        files = []
+        for path in self.cache_dir.rglob('*' + self.SUFFIX):
+            stat = path.stat()
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        oldest_allowed = time.time() - self.max_age.total_seconds() if self.max_age else None
+        removed = 0
+        for mtime, size, path in files:
+            if total <= self.max_bytes and (oldest_allowed is None or mtime >= oldest_allowed):
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"Из кэша ответов API удалено файлов: {removed}, осталось {total} байт")
+        return removed
+
+
+# Пишем ответ во временный файл по мере скачивания и переименовываем только после
+# полного ответа, поэтому оборванная загрузка не оставляет в кэше битых окон
+class ResponseCacheWriter:
+    def __init__(self, path: Path, compresslevel: int = 6):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        self._file = gzip.open(self.tmp_path, 'wb', compresslevel=compresslevel)
+
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+
+    def commit(self):
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        self._file.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+
+# ------------------------------------------------------
+# Инкрементальный режим: храним границу последней успешной загрузки
+# ------------------------------------------------------
+
+# Каждый запуск начинает с сохраненной границы (watermark) минус перекрытие для опоздавших записей
+# и идет до текущего момента. Включается флагом --incremental, по умолчанию грузится --start/--end
+INCREMENTAL = False
+WATERMARK_OVERLAP = timedelta(hours=1)
+
+def load_watermark(state_file, client):
+    state_file = Path(state_file)
+    if not state_file.exists():
+        return None
+    with open(state_file, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    return state.get(client, {}).get('watermark')
+
+# Записываем через временный файл, чтобы прерванный запуск не испортил состояние
+def save_watermark(state_file, client, watermark):
+    state_file = Path(state_file)
+    state = {}
+    if state_file.exists():
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    state.setdefault(client, {})['watermark'] = watermark
+
+    tmp_file = state_file.with_name(state_file.name + '.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, state_file)
+
+# Вычисляем интервал запуска: от watermark (с перекрытием) до текущего момента
+def incremental_params(params, state_file, overlap=WATERMARK_OVERLAP):
+    run_params = dict(params)
+    watermark = load_watermark(state_file, params['client'])
+    if watermark:
+        start = datetime.strptime(watermark, DATE_FORMAT) - overlap
+        run_params['start'] = start.strftime(DATE_FORMAT)
+    run_params['end'] = datetime.now().strftime(DATE_FORMAT)
+    return run_params
 
 # ------------------------------------------------------
 # Проверяем валидность данных и подготавливаем к заливке в базу
 # ------------------------------------------------------
-logger.info("Начинаем валидацию данных")
+
+# Компактная валидная запись: __slots__ вместо словаря, повторяющиеся строки интернируются
+class TrainingRecord:
+    __slots__ = ('user_id', 'oauth_consumer_key', 'lis_result_sourcedid', 'lis_outcome_service_url',
+                 'is_correct', 'attempt_type', 'created_at')
+
+    def __init__(self, user_id, oauth_consumer_key, lis_result_sourcedid, lis_outcome_service_url,
+                 is_correct, attempt_type, created_at):
+        self.user_id = user_id
+        self.oauth_consumer_key = _intern(oauth_consumer_key)
+        self.lis_result_sourcedid = lis_result_sourcedid
+        self.lis_outcome_service_url = _intern(lis_outcome_service_url)
+        self.is_correct = is_correct
+        self.attempt_type = _intern(attempt_type)
+        self.created_at = created_at
+
+    # Строка таблицы в порядке полей CSV/COPY
+    def as_row(self) -> Tuple:
+        return (self.user_id, self.oauth_consumer_key, self.lis_result_sourcedid,
+                self.lis_outcome_service_url, self.is_correct, self.attempt_type, self.created_at)
+
+    def __eq__(self, other):
+        if not isinstance(other, TrainingRecord):
+            return NotImplemented
+        return self.as_row() == other.as_row()
+
+    def __repr__(self):
+        return f"TrainingRecord{self.as_row()}"
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+# ------------------------------------------------------
+# Потоковая запись ошибок
+# ------------------------------------------------------
+
+# Граница, после которой в тексте ошибки идет конкретное значение
+_ERROR_VALUE_SEPARATOR = re.compile(r':| \(|, got')
+
+# Категория ошибки "поле: причина" без конкретного значения, например
+# "user_id: Invalid user_id format: 123" -> "user_id: Invalid user_id format"
+def error_category(error: str) -> str:
+    field, _, reason = error.partition(': ')
+    if not reason.startswith('Missing required field'):
+        reason = _ERROR_VALUE_SEPARATOR.split(reason, 1)[0]
+    return f"{field}: {reason.strip()}"
+
+
+# Пишет невалидные записи в JSONL по мере появления, с ротацией файла по размеру.
+# В памяти остается только ограниченная выборка примеров на каждую категорию ошибок
+class ErrorSink:
+    def __init__(self, file_path, max_bytes=50 * 1024 * 1024, backup_count=5, sample_size=10):
+        self.file_path = Path(file_path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.sample_size = sample_size
+        self.samples = {}
+        self.written = 0
+        self._file = None
+        self._size = 0
+
+    def write(self, record, errors: List[str], categories: Optional[List[str]] = None):
+        if self._file is None:
+            self.file_path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.file_path, 'a', encoding='utf-8')
+            self._size = self.file_path.stat().st_size
+
+        line = json.dumps({'record': record, 'errors': errors}, ensure_ascii=False, default=str) + '\n'
+        line_size = len(line.encode('utf-8'))
+        if self.max_bytes and self._size and self._size + line_size > self.max_bytes:
+            self._rotate()
+        self._file.write(line)
+        self._size += line_size
+        self.written += 1
+
+        for category in set(categories or map(error_category, errors)):
+            samples = self.samples.setdefault(category, [])
+            if len(samples) < self.sample_size:
+                samples.append({'original_record': record, 'errors': errors})
+
+    # errors.jsonl -> errors.jsonl.1 -> errors.jsonl.2 ..., самый старый файл удаляется
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = self.file_path.with_name(f"{self.file_path.name}.{i}")
+            if source.exists():
+                os.replace(source, self.file_path.with_name(f"{self.file_path.name}.{i + 1}"))
+        if self.backup_count > 0:
+            os.replace(self.file_path, self.file_path.with_name(f"{self.file_path.name}.1"))
+        else:
+            os.remove(self.file_path)
+        self._file = open(self.file_path, 'a', encoding='utf-8')
+        self._size = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# Ограниченный LRU-кэш результатов разбора passback_params с подсчетом попаданий
+class PassbackParamsCache:
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key: str):
+        result = self._data.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key: str, value):
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self._data)
+
 
 class RecordValidator:
-    def __init__(self, logger):
+    # Шаблоны компилируются один раз на класс, а не на каждую запись
+    USER_ID_PATTERN = re.compile(r'^[a-f0-9]{32}$')
+    URL_PATTERN = re.compile(r'^https?://[^\s/$.?#].[^\s]*$')
+    # Строгий формат '%Y-%m-%d %H:%M:%S.%f' с 6 знаками микросекунд, остальное разбирает strptime
+    FAST_DATE_PATTERN = re.compile(
+        r'([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):([0-9]{2}):([0-9]{2})\.([0-9]{6})')
+    VALID_ATTEMPT_TYPES = ['run', 'submit']
+    IS_CORRECT_STRINGS = {
+        'true': True, '1': True, 'yes': True, 'y': True,
+        'false': False, '0': False, 'no': False, 'n': False
+    }
+    # Плоский словарь строк без экранирования: {'key': 'value', ...}
+    _QUOTED = r"'[^'\\\r\n\x00]*'" + r'|"[^"\\\r\n\x00]*"'
+    PASSBACK_ITEM_PATTERN = re.compile(rf"({_QUOTED})[ \t]*:[ \t]*({_QUOTED})")
+    FLAT_DICT_PATTERN = re.compile(
+        rf"\{{(?:[ \t]*(?:{_QUOTED})[ \t]*:[ \t]*(?:{_QUOTED})[ \t]*,)*"
+        rf"(?:[ \t]*(?:{_QUOTED})[ \t]*:[ \t]*(?:{_QUOTED})[ \t]*)?\}}")
+
+    def __init__(self, logger, batch_size=5000, passback_cache_size=4096, error_sink=None):
         self.logger = logger
+        self.batch_size = batch_size
+        self.passback_cache = PassbackParamsCache(passback_cache_size)
+        # Если sink задан, ошибки пишутся в него сразу и не копятся в self.errors
+        self.error_sink = error_sink
         self.errors = []
         self.valid_records = []
-        self.statistics = {
+        self.statistics = self.new_statistics()
+
+    @staticmethod
+    def new_statistics():
+        return {
             'total_records': 0,
             'valid_records': 0,
             'invalid_records': 0,
             'errors_by_type': {}
         }
+
+    # Добавляем к своей статистике статистику другого валидатора (например, из рабочего процесса)
+    def merge_statistics(self, statistics: Dict):
+        for key, value in statistics.items():
+            if isinstance(value, dict):
+                merged = self.statistics.setdefault(key, {})
+                for error_type, count in value.items():
+                    merged[error_type] = merged.get(error_type, 0) + count
+            else:
+                self.statistics[key] = self.statistics.get(key, 0) + value
     
     # Проверяем user_id
     def validate_user_id(self, user_id: Any):
@@ -156,23 +1005,33 @@ class RecordValidator:
             return None, "user_id is empty"
         
         user_id_str = str(user_id)
-        if re.match(r'^[a-f0-9]{32}$', user_id_str.lower()):
+        if self.USER_ID_PATTERN.match(user_id_str.lower()):
             return user_id_str, None
         else:
             return None, f"Invalid user_id format: {user_id_str}"
     
     # Проверяем date
-    def validate_date(self, date: Any):
+    def validate_date(self, date: Any, now: Optional[datetime] = None):
         if not date:
             return None, "date is empty"
         try:
             date_str = str(date)
-            parsed_date = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S.%f')
-            if parsed_date > datetime.now():
+            parsed_date, normalized = self.parse_date(date_str)
+            if parsed_date > (now or datetime.now()):
                 return None, f"Date is in the future: {date_str}"
-            return date_str, None
+            return normalized, None
         except ValueError:
             return None, f"Invalid date format: {date}."
+
+    # Быстрый разбор даты без strptime для типичного формата API.
+    # Вместе с датой отдаем строку в строгом DATE_FORMAT: нестрогие строки, которые принимает strptime
+    # (например, '2023-4-1 1:2:3.5'), приводим к нему, чтобы CSV, бинарный COPY и Arrow получали одно значение
+    def parse_date(self, date_str: str) -> Tuple[datetime, str]:
+        match = self.FAST_DATE_PATTERN.fullmatch(date_str)
+        if match:
+            return datetime(*map(int, match.groups())), date_str
+        parsed_date = datetime.strptime(date_str, DATE_FORMAT)
+        return parsed_date, parsed_date.strftime(DATE_FORMAT)
     
     # Проверяем attempt_type (ожидается 'run' или 'submit')  
     def validate_attempt_type(self, attempt_type: Any):
@@ -183,7 +1042,7 @@ class RecordValidator:
         if not attempt_type_str:
             return None, "attempt_type is empty"
         
-        valid_types = ['run', 'submit'] 
+        valid_types = self.VALID_ATTEMPT_TYPES
         if attempt_type_str in valid_types:
             return attempt_type_str, None
         else:
@@ -208,10 +1067,8 @@ class RecordValidator:
                 return bool(is_correct), None
             elif isinstance(is_correct, str):
                 lower_val = is_correct.lower().strip()
-                if lower_val in ('true', '1', 'yes', 'y'):
-                    return True, None
-                elif lower_val in ('false', '0', 'no', 'n'):
-                    return False, None
+                if lower_val in self.IS_CORRECT_STRINGS:
+                    return self.IS_CORRECT_STRINGS[lower_val], None
                 else:
                     return None, f"Invalid is_correct value for submit (expected boolean, got: {is_correct})"
             else:
@@ -225,6 +1082,11 @@ class RecordValidator:
     def parse_passback_params(self, passback_params_str: str):
         if not passback_params_str:
             return None, "passback_params is empty"
+
+        # Быстрый путь для типичного формата, literal_eval только для нестандартных строк
+        if isinstance(passback_params_str, str) and self.FLAT_DICT_PATTERN.fullmatch(passback_params_str):
+            return {key[1:-1]: value[1:-1] for key, value
+                    in self.PASSBACK_ITEM_PATTERN.findall(passback_params_str)}, None
         try:
             params_dict = ast.literal_eval(passback_params_str)
             if isinstance(params_dict, dict):
@@ -256,125 +1118,272 @@ class RecordValidator:
         # Проверяем URL lis_outcome_service_url
         if 'lis_outcome_service_url' in params_dict and params_dict['lis_outcome_service_url']:
             url = params_dict['lis_outcome_service_url']
-            url_pattern = r'^https?://[^\s/$.?#].[^\s]*$'
-            if not re.match(url_pattern, str(url)):
+            if not self.URL_PATTERN.match(str(url)):
                 errors.append(f"Invalid lis_outcome_service_url format: {url}")
         
         return errors
     
+    # Разбираем и проверяем passback_params целиком, повторяющиеся строки берем из кэша
+    def check_passback_params(self, passback_params_str: Any):
+        cacheable = isinstance(passback_params_str, str)
+        if cacheable:
+            result = self.passback_cache.get(passback_params_str)
+            if result is not None:
+                return result
+
+        passback_params_dict, error = self.parse_passback_params(passback_params_str)
+        if passback_params_dict:
+            result = passback_params_dict, error, self.validate_passback_params_dict(passback_params_dict)
+        else:
+            result = passback_params_dict, error, []
+
+        if cacheable:
+            self.passback_cache.put(passback_params_str, result)
+        return result
+
     def process_record(self, record: Dict):
-        valid_record = {}
+        self.statistics['total_records'] += 1
+
+        return self.build_record(
+            record,
+            self.validate_user_id(record.get('lti_user_id')),
+            self.validate_date(record.get('created_at')),
+            self.validate_is_correct(record.get('is_correct'), record.get('attempt_type')),
+            self.validate_attempt_type(record.get('attempt_type')),
+            self.check_passback_params(record.get('passback_params'))
+        )
+
+    # Валидируем пачку записей теми же проверками, что и process_record, но с одним datetime.now()
+    # на всю пачку и с методами, взятыми в локальные переменные один раз
+    def process_batch(self, records: List[Dict]) -> List[TrainingRecord]:
+        self.statistics['total_records'] += len(records)
+        now = datetime.now()
+        validate_user_id = self.validate_user_id
+        validate_date = self.validate_date
+        validate_is_correct = self.validate_is_correct
+        validate_attempt_type = self.validate_attempt_type
+        check_passback_params = self.check_passback_params
+        build_record = self.build_record
+
+        valid_records = []
+        for record in records:
+            get = record.get
+            attempt_type = get('attempt_type')
+            valid_record = build_record(
+                record,
+                validate_user_id(get('lti_user_id')),
+                validate_date(get('created_at'), now),
+                validate_is_correct(get('is_correct'), attempt_type),
+                validate_attempt_type(attempt_type),
+                check_passback_params(get('passback_params'))
+            )
+            if valid_record:
+                valid_records.append(valid_record)
+        return valid_records
+
+    # Собираем валидную запись или ошибки из результатов проверок отдельных полей
+    def build_record(self, record: Dict, user_id_result, date_result, is_correct_result,
+                     attempt_type_result, passback_result):
         record_errors = []
 
-        self.statistics['total_records'] += 1     
-        
         # Проверяем user_id
-        user_id, error = self.validate_user_id(record.get('lti_user_id'))
-        if user_id:
-            valid_record['user_id'] = user_id
-        else:
+        user_id, error = user_id_result
+        if not user_id:
             record_errors.append(f"user_id: {error}")
         
         # Проверяем date(created_at)
-        date, error = self.validate_date(record.get('created_at'))
-        if date:
-            valid_record['date'] = date
-        else:
+        date, error = date_result
+        if not date:
             record_errors.append(f"date: {error}")
 
         # Валидация is_correct
-        is_correct, error = self.validate_is_correct(record.get('is_correct'), 
-    record.get('attempt_type'))
-        if error is None:
-            valid_record['is_correct'] = is_correct
-        else:
+        is_correct, error = is_correct_result
+        if error is not None:
             record_errors.append(f"is_correct: {error}")
         
         # Валидация attempt_type
-        attempt_type, error = self.validate_attempt_type(record.get('attempt_type'))
-        if attempt_type:
-            valid_record['attempt_type'] = attempt_type
-        else:
+        attempt_type, error = attempt_type_result
+        if not attempt_type:
             record_errors.append(f"attempt_type: {error}")
         
         # Парсим и валидируем passback_params
-        passback_params_dict, error = self.parse_passback_params(record.get('passback_params'))
+        passback_params_dict, error, param_errors = passback_result
         if passback_params_dict:
-            
-            param_errors = self.validate_passback_params_dict(passback_params_dict)
             if param_errors:
                 record_errors.extend([f"passback_params: {e}" for e in param_errors])
-            else:
-                # Сохраняем распарсенный словарь
-                valid_record['passback_params'] = passback_params_dict
-                
-                # Извлекаем отдельные поля для удобства
-                valid_record['oauth_consumer_key'] = passback_params_dict.get('oauth_consumer_key')
-                valid_record['lis_result_sourcedid'] = passback_params_dict.get('lis_result_sourcedid')
-                valid_record['lis_outcome_service_url'] = passback_params_dict.get('lis_outcome_service_url')
         else:
             record_errors.append(f"passback_params: {error}")
         
         # Если есть ошибки
         if record_errors:
             self.statistics['invalid_records'] += 1
-            #self.statistics['errors_by_type'][len(record_errors)] = \
-              #  self.statistics['errors_by_type'].get(len(record_errors), 0) + 1
+
+            categories = [error_category(error) for error in record_errors]
+            errors_by_type = self.statistics['errors_by_type']
+            for category in categories:
+                errors_by_type[category] = errors_by_type.get(category, 0) + 1
             
-            self.errors.append({
-                'original_record': record,
-                'errors': record_errors
-            })
+            if self.error_sink is not None:
+                self.error_sink.write(record, record_errors, categories)
+            else:
+                self.errors.append({
+                    'original_record': record,
+                    'errors': record_errors
+                })
             return None
         else:
             self.statistics['valid_records'] += 1
-            return valid_record
+            # Из passback_params забираем только нужные поля, сам словарь не храним.
+            # После literal_eval значения могут быть не строками (например, ключ числом 123):
+            # приводим к строке, как их записал бы CSV, чтобы COPY, справочники и Arrow получали str
+            return TrainingRecord(
+                user_id=user_id,
+                oauth_consumer_key=str(passback_params_dict['oauth_consumer_key']),
+                lis_result_sourcedid=str(passback_params_dict['lis_result_sourcedid']),
+                lis_outcome_service_url=str(passback_params_dict['lis_outcome_service_url']),
+                is_correct=is_correct,
+                attempt_type=attempt_type,
+                created_at=date
+            )
      
         
-    # Обрабатываем сырые скачанные данные
-    def process_records(self, raw_data):
+    # Обрабатываем сырые скачанные данные.
+    # При workers > 1 записи режутся на куски по chunk_size и проверяются в отдельных процессах
+    def process_records(self, raw_data, workers: int = 1, chunk_size: int = 20000):
         self.valid_records = []
-        self.statistics['total_records'] = len(raw_data) if raw_data else 0
-        self.logger.info(f"Начинаем валидацию {self.statistics['total_records']} записей")
+        # total_records считается в process_record, поэтому raw_data может быть и генератором
+        if hasattr(raw_data, '__len__'):
+            self.logger.info(f"Начинаем валидацию {len(raw_data)} записей")
+        else:
+            self.logger.info("Начинаем потоковую валидацию записей")
 
-        for record in raw_data:
-            valid_record = self.process_record(record)
-            if valid_record:
-                self.valid_records.append(valid_record)
+        if workers > 1:
+            self.process_records_parallel(raw_data or [], workers, chunk_size)
+        else:
+            # Валидируем пачками по batch_size записей
+            for batch in iter_chunks(raw_data or [], self.batch_size):
+                self.valid_records.extend(self.process_batch(batch))
         self.logger.info(f"Валидация завершена. Валидных записей: {self.statistics['valid_records']}, невалидных: {self.statistics['invalid_records']}")
+        self.logger.info(f"Кэш passback_params: попаданий {self.passback_cache.hits}, "
+                         f"промахов {self.passback_cache.misses} ({self.passback_cache.hit_rate:.1%})")
         return self.valid_records
     
+    # Результаты кусков забираются строго в порядке отправки, поэтому порядок записей,
+    # ошибок и итоговые счетчики совпадают с последовательным запуском
+    def process_records_parallel(self, raw_data, workers: int, chunk_size: int):
+        self.logger.info(f"Параллельная валидация: процессов {workers}, размер куска {chunk_size}")
+        for valid_records in self.iter_process_parallel(iter_chunks(raw_data, chunk_size), workers):
+            self.valid_records.extend(valid_records)
+        return self.valid_records
+
+    # Отдаем валидные записи каждого куска по мере готовности, в порядке кусков
+    def iter_process_parallel(self, chunks, workers: int):
+        from concurrent.futures import ProcessPoolExecutor
+        max_pending = workers * 2
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_validation_worker,
+                                 initargs=(self.batch_size, self.passback_cache.maxsize)) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_validate_chunk, chunk))
+                # Ограничиваем число кусков в работе, чтобы не держать весь поток в памяти
+                if len(pending) >= max_pending:
+                    yield self._merge_chunk_result(pending.popleft().result())
+            while pending:
+                yield self._merge_chunk_result(pending.popleft().result())
+
+    def _merge_chunk_result(self, result):
+        valid_records, errors, statistics, cache_hits, cache_misses = result
+        if self.error_sink is not None:
+            for error_item in errors:
+                self.error_sink.write(error_item['original_record'], error_item['errors'])
+        else:
+            self.errors.extend(errors)
+        self.merge_statistics(statistics)
+        self.passback_cache.hits += cache_hits
+        self.passback_cache.misses += cache_misses
+        return valid_records
+
     # Сохраняем ошибки в файл
     def save_errors(self, filename: str = None, file_path: str = None):
-        save_path = project_root
+        save_path = Path(file_path) if file_path is not None else project_root
 
         if filename is None:
            current_date = datetime.now().strftime('%Y%m%d')
            filename = f'errors_{current_date}.txt'
      
         file_path = save_path / filename
+        invalid_count = self.statistics['invalid_records']
         
         with open(file_path, 'w', encoding='utf-8') as f:
             f.write("СТАТИСТИКА ОШИБОК\n")
-            f.write(f"Всего записей с ошибками: {len(self.errors)}\n")
+            f.write(f"Всего записей с ошибками: {invalid_count}\n")
+
+            f.write("Ошибок по типам:\n")
+            for category, count in sorted(self.statistics['errors_by_type'].items(),
+                                          key=lambda item: -item[1]):
+                f.write(f"  {count:>8}  {category}\n")
+            f.write("-" * 50 + "\n")
+
+            # При потоковой записи здесь только примеры, все ошибки лежат в JSONL
+            if self.error_sink is not None:
+                f.write(f"Все ошибки: {self.error_sink.file_path}\n")
+                error_items = [item for samples in self.error_sink.samples.values() for item in samples]
+            else:
+                error_items = self.errors
             
-            for error_item in self.errors:
+            for error_item in error_items:
                 f.write(f"Record: {error_item['original_record']}\n")
                 for error in error_item['errors']:
                     f.write(f"  - {error}\n")
                 f.write("-" * 50 + "\n")
         self.logger.info(f"Ошибки сохранены в файл: {filename}")
-        self.logger.info(f"Всего записей с ошибками: {len(self.errors)}")
+        self.logger.info(f"Всего записей с ошибками: {invalid_count}")
     
-validator = RecordValidator(logger)
-valid_records = validator.process_records(raw_data)
+# ------------------------------------------------------
+# Валидация в рабочих процессах
+# ------------------------------------------------------
+
+# Валидатор создается один раз на процесс, чтобы кэш passback_params жил между кусками
+_worker_validator = None
+
+def _init_validation_worker(batch_size, passback_cache_size):
+    global _worker_validator
+    _worker_validator = RecordValidator(logging.getLogger('validation_worker'), batch_size=batch_size,
+                                        passback_cache_size=passback_cache_size)
+
+def _validate_chunk(chunk):
+    validator = _worker_validator
+    validator.errors = []
+    validator.statistics = validator.new_statistics()
+    cache_hits, cache_misses = validator.passback_cache.hits, validator.passback_cache.misses
+
+    valid_records = []
+    for batch in iter_chunks(chunk, validator.batch_size):
+        valid_records.extend(validator.process_batch(batch))
+
+    return (valid_records, validator.errors, validator.statistics,
+            validator.passback_cache.hits - cache_hits, validator.passback_cache.misses - cache_misses)
 
-validator.save_errors()
+# Параметры валидации: размер пачки, число процессов и размер куска на процесс
+VALIDATION_CONFIG = {
+    'batch_size': 5000,
+    'workers': os.cpu_count() or 1,
+    'chunk_size': 20000
+}
 
 # ------------------------------------------------------
 # Сохраняем записи в csv файл
 # ------------------------------------------------------
 
+# Порядок полей в CSV и в COPY
+CSV_FIELDNAMES = ['user_id',
+                  'oauth_consumer_key', 'lis_result_sourcedid',
+                  'lis_outcome_service_url', 'is_correct', 'attempt_type', 'created_at']
+
+# CSV больше не нужен для загрузки в базу, это дополнительная выгрузка
+EXPORT_CSV = False
+
 def save_to_csv(valid_records, filename='training_data.csv', custom_path=None):
         
     if not valid_records:
@@ -393,31 +1402,16 @@ def save_to_csv(valid_records, filename='training_data.csv', custom_path=None):
     # Полный путь к файлу
     file_path = save_dir / filename
     
-    # Определяем поля для CSV
-    fieldnames = ['user_id',  
-                  'oauth_consumer_key', 'lis_result_sourcedid', 
-                  'lis_outcome_service_url', 'is_correct', 'attempt_type', 'created_at']
-    
     try:
         logger.info(f"Начинаем сохранение {len(valid_records)} записей в CSV файл")
         with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer = csv.writer(csvfile)
             
             # Записываем заголовок
-            writer.writeheader()
+            writer.writerow(CSV_FIELDNAMES)
             
             # Записываем данные
-            for record in valid_records:
-                csv_record = {
-                    'user_id': record.get('user_id'),
-                    'oauth_consumer_key': record.get('oauth_consumer_key'),
-                    'lis_result_sourcedid': record.get('lis_result_sourcedid'),
-                    'lis_outcome_service_url': record.get('lis_outcome_service_url'),
-                    'is_correct': record.get('is_correct'),
-                    'attempt_type': record.get('attempt_type'),
-                    'created_at': record.get('date')
-                }
-                writer.writerow(csv_record)
+            writer.writerows(record.as_row() for record in valid_records)
         
         logger.info(f"Данные успешно сохранены в {file_path}")
         logger.info(f"Всего записей: {len(valid_records)}")
@@ -427,174 +1421,1851 @@ def save_to_csv(valid_records, filename='training_data.csv', custom_path=None):
     except Exception as e:
         logger.error(f" Ошибка при сохранении в CSV: {e}")
         return False
-    
-# Сохраняем данные в CSV
-csv_filename = 'training_data.csv'
-csv_file_path = save_to_csv(valid_records, csv_filename)
 
 # ------------------------------------------------------
-# Импорт данных из csv в базу
+# Колоночная выгрузка: Parquet или Arrow IPC
 # ------------------------------------------------------
 
-def import_csv_to_postgresql(csv_file_path, db_config):
-    logger.info("Начинаем импортировать данные в POSTGRESQL")
-    conn = None
-    csv_path = Path(csv_file_path)
+# Для аналитики вместо CSV: настоящие типы (timestamp, bool), словарное кодирование
+# повторяющихся строк и сжатие. pyarrow нужен только для этой выгрузки
+EXPORT_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+DICTIONARY_COLUMNS = ('oauth_consumer_key', 'lis_outcome_service_url', 'attempt_type')
 
-    if not csv_path.exists():
-        logger.error(f"CSV файл не найден: {csv_path}")
-        print(f"CSV файл не найден: {csv_path}")
-        return False
-       
+def _import_pyarrow():
     try:
-        logger.info(f"Подключаемся к PostgreSQL")
-        conn = psycopg2.connect(**db_config)
-        cur = conn.cursor()
-        logger.info("Подключение к PostgreSQL успешно установлено")
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        raise ImportError("Для выгрузки в Parquet/Arrow нужен pyarrow: pip install pyarrow")
 
-        cur.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'training_data'
-            );
-        """)
-        table_exists = cur.fetchone()[0]
-
-        if not table_exists:
-            logger.info("Таблица не существует. Создаем новую таблицу...")
-            
-            create_table_query = """
-            CREATE TABLE training_data (
-                id SERIAL PRIMARY KEY,
-                user_id VARCHAR(32) NOT NULL,
-                oauth_consumer_key TEXT,
-                lis_result_sourcedid TEXT,
-                lis_outcome_service_url TEXT,
-                is_correct BOOLEAN,
-                attempt_type VARCHAR(10) NOT NULL,
-                created_at TIMESTAMP NOT NULL,
-                -- Добавляем уникальное ограничение для предотвращения дубликатов
-                CONSTRAINT unique_user_attempt UNIQUE (user_id, created_at, attempt_type)
-            );
-            
-            -- Создаем индексы для ускорения поиска
-            CREATE INDEX idx_training_user_id ON training_data(user_id);
-            CREATE INDEX idx_training_created_at ON training_data(created_at);
-            """
-            cur.execute(create_table_query)
-            conn.commit()
-            logger.info("Таблица успешно создана")
-        else:
-            logger.info("Таблица уже существует")
-        
-        # Получаем существующие записи для проверки дубликатов
-        logger.info("Проверяем существующие записи для предотвращения дубликатов...")
-        cur.execute("""
-            SELECT user_id, created_at, attempt_type 
-            FROM training_data
-        """)
-        existing_records = set()
-        for row in cur.fetchall():
-            # Создаем ключ для проверки дубликатов
-            existing_records.add((row[0], str(row[1]), row[2]))
-        
-        logger.info(f"Найдено существующих записей: {len(existing_records)}")
-        
-        # Читаем CSV и фильтруем новые записи
-        new_records = []
-        duplicates_skipped = 0
-        
-        with open(csv_path, 'r', encoding='utf-8') as f:
-            csv_reader = csv.DictReader(f)
-            
-            for row in csv_reader:
-                # Создаем ключ для проверки
-                record_key = (
-                    row['user_id'],
-                    row['created_at'],
-                    row['attempt_type']
-                )
-                
-                # Проверяем, существует ли уже такая запись
-                if record_key in existing_records:
-                    duplicates_skipped += 1
-                    continue
-                
-                new_records.append(row)
-        
-        logger.info(f"Новых записей для импорта: {len(new_records)}")
-        logger.info(f"Пропущено дубликатов: {duplicates_skipped}")
-        
-        # Импортируем только новые записи
-        if new_records:
-            logger.info("Начинаем импорт новых записей в PostgreSQL...")
-            temp_csv = csv_path.parent / 'temp_import.csv'
-            with open(temp_csv, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=['user_id', 'oauth_consumer_key', 
-                                                       'lis_result_sourcedid', 'lis_outcome_service_url',
-                                                       'is_correct', 'attempt_type', 'created_at'])
-                writer.writeheader()
-                writer.writerows(new_records)
-            
-            # Импортируем новые записи
-            with open(temp_csv, 'r', encoding='utf-8') as f:
-                next(f)  # Пропускаем заголовок
-                cur.copy_expert("""
-                    COPY training_data 
-                    (user_id, oauth_consumer_key, lis_result_sourcedid, 
-                     lis_outcome_service_url, is_correct, attempt_type, created_at)
-                    FROM STDIN WITH CSV
-                """, f)
-            
-            conn.commit()
-            logger.info(f"Успешно импортировано {len(new_records)} новых записей")
-            print(f"Импортировано {len(new_records)} новых записей")
-            
-            # Удаляем временный файл
-            os.remove(temp_csv)
-            logger.debug(f"Временный файл {temp_csv} удален")
-        else:
-            logger.info("Нет новых записей для импорта")
-            print("ℹ Нет новых записей для импорта")
-           
-             
-        # Показываем итоговую статистику
-        cur.execute("SELECT COUNT(*) FROM training_data")
-        total_count = cur.fetchone()[0]
-        logger.info(f"Всего записей в таблице: {total_count}")
-        
-        cur.close()
+# Собираем таблицу Arrow по колонкам. Даты в строках разбирает сам Arrow при приведении
+# к timestamp, без datetime.strptime на каждую запись
+def records_to_arrow_table(valid_records, partition_by_date=False):
+    pa = _import_pyarrow()
+    columns = {field: [] for field in CSV_FIELDNAMES}
+    appends = [columns[field].append for field in CSV_FIELDNAMES]
+    for record in valid_records:
+        for append, value in zip(appends, record.as_row()):
+            append(value)
 
-        logger.info("Импорт в базу успешно завершен")
-       
-        return True
+    arrays = arrow_arrays(pa, columns)
+    if partition_by_date:
+        arrays['created_date'] = arrays['created_at'].cast(pa.date32())
+    return pa.table(arrays)
 
-    except psycopg2.OperationalError as e:
-        logger.error(f"Ошибка подключения к PostgreSQL: {e}")
-        return False
+# Массивы Arrow с типами выгрузки. created_at приходит строками из API или datetime из базы
+def arrow_arrays(pa, columns):
+    arrays = {}
+    for field, values in columns.items():
+        if field == 'id':
+            arrays[field] = pa.array(values, type=pa.int64())
+        elif field == 'is_correct':
+            arrays[field] = pa.array(values, type=pa.bool_())
+        elif field == 'created_at':
+            arrays[field] = pa.array(values).cast(pa.timestamp('us'))
+        elif field in DICTIONARY_COLUMNS:
+            arrays[field] = pa.array(values, type=pa.string()).dictionary_encode()
+        else:
+            arrays[field] = pa.array(values, type=pa.string())
+    return arrays
 
-    except Exception as e:
+def save_to_columnar(valid_records, export_format='parquet', custom_path=None, compression='zstd',
+                     partition_by_date=False):
+    if not valid_records:
+        logger.info("Нет валидных записей для сохранения")
+        return False
+
+    save_dir = Path(custom_path) if custom_path is not None else project_root
+    save_dir.mkdir(parents=True, exist_ok=True)
+
+    try:
+        logger.info(f"Начинаем сохранение {len(valid_records)} записей в {export_format}")
+        table = records_to_arrow_table(valid_records, partition_by_date)
+
+        if partition_by_date:
+            # Каталоги created_date=YYYY-MM-DD; имя файла с отметкой запуска, чтобы не перезаписывать
+            # выгрузки прошлых запусков за те же дни
+            import pyarrow.dataset as ds
+            target = save_dir / f"training_data_{export_format}"
+            file_format = ds.ParquetFileFormat() if export_format == 'parquet' else ds.IpcFileFormat()
+            ds.write_dataset(table, target, format=file_format,
+                             file_options=file_format.make_write_options(compression=compression),
+                             partitioning=['created_date'], partitioning_flavor='hive',
+                             basename_template=f"part-{datetime.now().strftime('%Y%m%d%H%M%S')}-{{i}}"
+                                               f"{EXPORT_FORMATS[export_format]}",
+                             existing_data_behavior='overwrite_or_ignore')
+            size = sum(path.stat().st_size for path in target.rglob('*') if path.is_file())
+        else:
+            target = save_dir / f"training_data{EXPORT_FORMATS[export_format]}"
+            if export_format == 'parquet':
+                import pyarrow.parquet as pq
+                pq.write_table(table, target, compression=compression)
+            else:
+                pa = _import_pyarrow()
+                options = pa.ipc.IpcWriteOptions(compression=compression)
+                with pa.OSFile(str(target), 'wb') as sink:
+                    with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                        writer.write_table(table)
+            size = target.stat().st_size
+
+        logger.info(f"Данные успешно сохранены в {target} ({size} байт)")
+        return target, size
+
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении в {export_format}: {e}")
+        return False
+
+# ------------------------------------------------------
+# Загрузка данных в базу
+# ------------------------------------------------------
+
+# Файлоподобный объект поверх итератора строк: COPY читает его кусками,
+# и строки формируются по мере чтения, без промежуточных файлов.
+# binary=True - итератор отдает bytes (бинарный COPY)
+class IteratorFile(io.TextIOBase):
+    def __init__(self, lines, binary=False):
+        self._lines = iter(lines)
+        self._binary = binary
+        self._buffer = b'' if binary else ''
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+
+        if size < 0:
+            data, self._buffer = self._buffer, self._buffer[:0]
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.bytes_read += len(data) if self._binary else len(data.encode('utf-8'))
+        return data
+
+# Форматируем строки таблицы в CSV-строки для COPY
+def iter_csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+# ------------------------------------------------------
+# Бинарный COPY
+# ------------------------------------------------------
+
+# В бинарном формате PostgreSQL не разбирает текст: timestamp передается как int64 микросекунд
+# от 2000-01-01, bool - одним байтом, uuid - 16 байтами. Клиент тоже не форматирует CSV
+COPY_FORMAT = 'csv'
+
+PG_EPOCH = datetime(2000, 1, 1)
+BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+BINARY_COPY_TRAILER = struct.pack('>h', -1)
+_BINARY_NULL = struct.pack('>i', -1)
+_BINARY_TRUE = struct.pack('>ib', 1, 1)
+_BINARY_FALSE = struct.pack('>ib', 1, 0)
+_pack_length = struct.Struct('>i').pack
+_pack_int4 = struct.Struct('>ii').pack
+_pack_int8 = struct.Struct('>iq').pack
+
+# Кодировщики полей повторяют текстовый путь: пустая строка в CSV без кавычек - это NULL,
+# поэтому и здесь '' и None дают NULL
+def _encode_text(value):
+    if value is None or value == '':
+        return _BINARY_NULL
+    data = value.encode('utf-8')
+    return _pack_length(len(data)) + data
+
+def _encode_bool(value):
+    if value is None or value == '':
+        return _BINARY_NULL
+    if isinstance(value, str):
+        value = value.strip().lower() in ('true', 't', '1', 'yes', 'y', 'on')
+    return _BINARY_TRUE if value else _BINARY_FALSE
+
+# Как и колонка TIMESTAMP, часовой пояс в значении отбрасываем
+def _encode_timestamp(value):
+    if value is None or value == '':
+        return _BINARY_NULL
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    delta = value.replace(tzinfo=None) - PG_EPOCH
+    return _pack_int8(8, (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+def _encode_uuid(value):
+    if value is None or value == '':
+        return _BINARY_NULL
+    return _pack_length(16) + bytes.fromhex(value.replace('-', ''))
+
+def _encode_int4(value):
+    if value is None:
+        return _BINARY_NULL
+    return _pack_int4(4, value)
+
+# Кодировщики в порядке колонок COPY: обычная схема / компактная (enum передается текстом метки)
+BINARY_ENCODERS = {
+    False: (_encode_text, _encode_text, _encode_text, _encode_text, _encode_bool, _encode_text,
+            _encode_timestamp),
+    True: (_encode_uuid, _encode_int4, _encode_text, _encode_int4, _encode_bool, _encode_text,
+           _encode_timestamp),
+}
+
+# Кодируем строки в бинарный формат COPY и отдаем кусками примерно по chunk_bytes
+def iter_binary_copy(rows, encoders, chunk_bytes=64 * 1024):
+    field_count = struct.pack('>h', len(encoders))
+    parts = [BINARY_COPY_HEADER]
+    size = len(BINARY_COPY_HEADER)
+    for row in rows:
+        data = field_count + b''.join([encode(value) for encode, value in zip(encoders, row)])
+        parts.append(data)
+        size += len(data)
+        if size >= chunk_bytes:
+            yield b''.join(parts)
+            parts = []
+            size = 0
+    parts.append(BINARY_COPY_TRAILER)
+    yield b''.join(parts)
+
+# Создаем таблицу, если ее еще нет.
+# to_regclass смотрит в search_path текущего соединения и не трогает information_schema.
+# Возвращаем фактическое устройство таблицы: {'partitioned': ..., 'compact': ...}
+def ensure_training_table(conn, cur, partitioned=False, compact=False):
+    layout = training_table_layout(cur)
+
+    if layout is None:
+        logger.info("Таблица не существует. Создаем новую таблицу...")
+
+        if compact:
+            cur.execute(COMPACT_DIMENSIONS_QUERY)
+        table_query = PARTITIONED_TABLE_QUERY if partitioned else PLAIN_TABLE_QUERY
+        cur.execute(table_query.format(columns=COMPACT_COLUMNS if compact else PLAIN_COLUMNS))
+        if compact:
+            cur.execute(COMPACT_VIEW_QUERY)
+        conn.commit()
+        logger.info("Таблица успешно создана" + (" (секции по месяцам)" if partitioned else "") +
+                    (" (компактная схема)" if compact else ""))
+        return {'partitioned': partitioned, 'compact': compact}
+
+    logger.info("Таблица уже существует")
+    if partitioned and not layout['partitioned']:
+        logger.warning("Таблица training_data создана без секций, --partitioned не применяется. "
+                       "Для перехода нужно перелить данные в новую секционированную таблицу")
+    if compact != layout['compact']:
+        logger.warning(f"Таблица training_data создана в {'компактной' if layout['compact'] else 'обычной'} "
+                       f"схеме, загрузка идет в ней")
+    return layout
+
+# Устройство существующей training_data или None, если таблицы нет
+def training_table_layout(cur):
+    cur.execute("""
+        SELECT c.relkind, EXISTS (
+            SELECT FROM pg_attribute a WHERE a.attrelid = c.oid AND a.attname = 'consumer_key_id'
+        )
+        FROM pg_class c WHERE c.oid = to_regclass('training_data')
+    """)
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return {'partitioned': row[0] == 'p', 'compact': bool(row[1])}
+
+# Колонки training_data в обычной схеме: текст хранится как есть
+PLAIN_COLUMNS = """
+    user_id VARCHAR(32) NOT NULL,
+    oauth_consumer_key TEXT,
+    lis_result_sourcedid TEXT,
+    lis_outcome_service_url TEXT,
+    is_correct BOOLEAN,
+    attempt_type VARCHAR(10) NOT NULL,
+    created_at TIMESTAMP NOT NULL"""
+
+PLAIN_TABLE_QUERY = """
+CREATE TABLE training_data (
+    id SERIAL PRIMARY KEY,{columns},
+    -- Добавляем уникальное ограничение для предотвращения дубликатов
+    CONSTRAINT unique_user_attempt UNIQUE (user_id, created_at, attempt_type)
+);
+
+-- Создаем индексы для ускорения поиска
+CREATE INDEX idx_training_user_id ON training_data(user_id);
+CREATE INDEX idx_training_created_at ON training_data(created_at);
+"""
+
+# Секции по месяцам created_at: ключ секции обязан входить в первичный ключ и уникальное ограничение.
+# Для выборок по периоду - BRIN по created_at: данные приходят почти упорядоченными по времени,
+# индекс занимает килобайты и почти не замедляет вставку. Keyset-чтению (created_at, id) > ...
+# нужен порядок, поэтому рядом B-tree (created_at, id): без него каждая страница сортировала бы
+# все оставшиеся строки
+PARTITIONED_TABLE_QUERY = """
+CREATE TABLE training_data (
+    id SERIAL,{columns},
+    PRIMARY KEY (id, created_at),
+    CONSTRAINT unique_user_attempt UNIQUE (user_id, created_at, attempt_type)
+) PARTITION BY RANGE (created_at);
+
+CREATE INDEX idx_training_user_id ON training_data(user_id);
+CREATE INDEX idx_training_created_at_brin ON training_data USING BRIN (created_at);
+CREATE INDEX idx_training_created_at_id ON training_data(created_at, id);
+"""
+
+KEYSET_INDEX = 'idx_training_created_at_id'
+
+# Добавляем индекс (created_at, id) в секционированную таблицу, созданную без него (--migrate-keyset-index).
+# Запускается явно: запись не блокируется, но построение на большой таблице идет долго.
+# Индекс родителя создается ON ONLY (пустой и невалидный, новые секции сразу получают свой),
+# индексы секций строятся CONCURRENTLY и подключаются к нему; после последней секции он становится валидным
+def migrate_keyset_index(db_config):
+    import psycopg2
+
+    conn = psycopg2.connect(**db_config)
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        layout = training_table_layout(cur)
+        if layout is None or not layout['partitioned']:
+            logger.info("training_data не секционирована, индекс (created_at, id) не нужен")
+            return True
+        cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (KEYSET_INDEX,))
+        row = cur.fetchone()
+        if row is not None and row[0]:
+            logger.info(f"Индекс {KEYSET_INDEX} уже есть")
+            return True
+
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {KEYSET_INDEX} ON ONLY training_data (created_at, id)")
+        # Секции, у которых индекс еще не подключен к родительскому
+        cur.execute("""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'training_data'::regclass
+              AND NOT EXISTS (
+                  SELECT FROM pg_inherits ii JOIN pg_index x ON x.indexrelid = ii.inhrelid
+                  WHERE ii.inhparent = to_regclass(%s) AND x.indrelid = c.oid)
+            ORDER BY c.relname
+        """, (KEYSET_INDEX,))
+        for (partition,) in cur.fetchall():
+            index = f"{partition}_created_at_id_idx"
+            # Индекс от прерванного CONCURRENTLY остается невалидным, его строим заново
+            cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (index,))
+            row = cur.fetchone()
+            if row is not None and not row[0]:
+                cur.execute(f"DROP INDEX CONCURRENTLY {index}")
+            logger.info(f"Строим индекс {index}...")
+            cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} ON {partition} (created_at, id)")
+            cur.execute(f"ALTER INDEX {KEYSET_INDEX} ATTACH PARTITION {index}")
+        cur.close()
+        logger.info(f"Индекс {KEYSET_INDEX} построен")
+        return True
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка при построении индекса {KEYSET_INDEX}: {e}")
+        return False
+    finally:
+        conn.close()
+
+# ------------------------------------------------------
+# Компактная схема
+# ------------------------------------------------------
+
+# user_id хранится как uuid (16 байт вместо 33), attempt_type - enum (4 байта),
+# а ключи потребителя и адреса outcome-сервиса, которых единицы, вынесены в справочники.
+# Строка таблицы и индексы по user_id заметно уменьшаются
+COMPACT_SCHEMA = False
+
+COMPACT_DIMENSIONS_QUERY = f"""
+CREATE TYPE training_attempt_type AS ENUM ({', '.join(f"'{value}'" for value in RecordValidator.VALID_ATTEMPT_TYPES)});
+CREATE TABLE training_consumer_keys (id SERIAL PRIMARY KEY, value TEXT NOT NULL UNIQUE);
+CREATE TABLE training_outcome_urls (id SERIAL PRIMARY KEY, value TEXT NOT NULL UNIQUE);
+"""
+
+COMPACT_COLUMNS = """
+    user_id UUID NOT NULL,
+    consumer_key_id INTEGER REFERENCES training_consumer_keys (id),
+    lis_result_sourcedid TEXT,
+    outcome_url_id INTEGER REFERENCES training_outcome_urls (id),
+    is_correct BOOLEAN,
+    attempt_type training_attempt_type NOT NULL,
+    created_at TIMESTAMP NOT NULL"""
+
+# Представление с прежними колонками для отчетов, написанных под обычную схему
+COMPACT_VIEW_QUERY = """
+CREATE VIEW training_data_wide AS
+SELECT d.id, replace(d.user_id::text, '-', '') AS user_id, k.value AS oauth_consumer_key,
+       d.lis_result_sourcedid, u.value AS lis_outcome_service_url, d.is_correct,
+       d.attempt_type::text AS attempt_type, d.created_at
+FROM training_data d
+LEFT JOIN training_consumer_keys k ON k.id = d.consumer_key_id
+LEFT JOIN training_outcome_urls u ON u.id = d.outcome_url_id
+"""
+
+# Порядок колонок при COPY в каждой из схем
+COMPACT_FIELDNAMES = ['user_id', 'consumer_key_id', 'lis_result_sourcedid', 'outcome_url_id',
+                      'is_correct', 'attempt_type', 'created_at']
+
+STAGING_COLUMNS = {
+    False: """
+        user_id VARCHAR(32),
+        oauth_consumer_key TEXT,
+        lis_result_sourcedid TEXT,
+        lis_outcome_service_url TEXT,
+        is_correct BOOLEAN,
+        attempt_type VARCHAR(10),
+        created_at TIMESTAMP""",
+    True: """
+        user_id UUID,
+        consumer_key_id INTEGER,
+        lis_result_sourcedid TEXT,
+        outcome_url_id INTEGER,
+        is_correct BOOLEAN,
+        attempt_type training_attempt_type,
+        created_at TIMESTAMP""",
+}
+
+# Справочник строк с маленькими целыми id. Различных значений единицы, поэтому id держим
+# в словаре процесса, а в базу ходим только за значениями, которых еще не видели
+class DimensionCache:
+    def __init__(self, table):
+        self.table = table
+        self.ids = {}
+        self._lock = threading.Lock()
+
+    # id значений для текущей транзакции: недостающие заводим, остальные дочитываем (в т.ч. созданные
+    # другим процессом). Новые значения заводятся под блокировкой до коммита, поэтому в общий кэш
+    # попадают только уже закоммиченные id: параллельные загрузки не ссылаются на чужие незакоммиченные
+    # строки и не ждут друг друга
+    def resolve(self, cur, values) -> Dict:
+        values = {value for value in values if value}
+        with self._lock:
+            ids = {value: self.ids[value] for value in values if value in self.ids}
+        missing = sorted(values - ids.keys())
+        if not missing:
+            return ids
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (self.table,))
+        cur.execute(f"""
+            INSERT INTO {self.table} (value) SELECT unnest(%s::text[])
+            ON CONFLICT (value) DO NOTHING
+            RETURNING value
+        """, (missing,))
+        created = {row[0] for row in cur.fetchall()}
+        cur.execute(f"SELECT value, id FROM {self.table} WHERE value = ANY(%s)", (missing,))
+        found = dict(cur.fetchall())
+        ids.update(found)
+        with self._lock:
+            self.ids.update((value, id_) for value, id_ in found.items() if value not in created)
+        return ids
+
+# ------------------------------------------------------
+# Секции по месяцам
+# ------------------------------------------------------
+
+PARTITIONED = False
+
+# Первое число месяца со сдвигом на months месяцев
+def add_months(month_start, months):
+    index = month_start.year * 12 + month_start.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+# Ведем список месячных секций training_data_yYYYYmMM и создаем недостающие перед вставкой пачки.
+# Список кэшируется, поэтому каталог читается один раз, а не на каждую пачку
+class MonthlyPartitions:
+    PARTITION_NAME_PATTERN = re.compile(r'^training_data_y(\d{4})m(\d{2})$')
+
+    def __init__(self, table='training_data'):
+        self.table = table
+        self._known = None
+
+    def partition_name(self, month_start):
+        return f"{self.table}_y{month_start.year:04d}m{month_start.month:02d}"
+
+    # Существующие секции: {первое число месяца: имя}
+    def list_partitions(self, cur):
+        cur.execute("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+        """, (self.table,))
+        partitions = {}
+        for (name,) in cur.fetchall():
+            match = self.PARTITION_NAME_PATTERN.match(name)
+            if match:
+                partitions[datetime(int(match.group(1)), int(match.group(2)), 1)] = name
+        return partitions
+
+    def ensure(self, cur, months):
+        if self._known is None:
+            self._known = set(self.list_partitions(cur))
+        missing = set(months) - self._known
+        if not missing:
+            return
+        # Создание секций сериализуем между потоками и процессами. Блокировка держится до коммита,
+        # поэтому следующий загрузчик перечитает каталог и увидит уже закоммиченные секции.
+        # Созданные здесь секции попадут в кэш при следующем чтении каталога, после коммита
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"{self.table}_partitions",))
+        self._known = set(self.list_partitions(cur))
+        for month_start in sorted(missing - self._known):
+            name = self.partition_name(month_start)
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {name} PARTITION OF {self.table}
+                FOR VALUES FROM (%s) TO (%s)
+            """, (month_start, add_months(month_start, 1)))
+            logger.info(f"Создана секция {name}")
+
+    # Месяцы берем из временной таблицы пачки: она маленькая, а основная таблица не читается
+    def ensure_for_staging(self, cur, staging_table='training_data_staging'):
+        cur.execute(f"SELECT DISTINCT date_trunc('month', created_at) FROM {staging_table}")
+        self.ensure(cur, [row[0] for row in cur.fetchall()])
+
+    # После отката транзакции созданные в ней секции исчезают, кэш нужно перечитать
+    def reset(self):
+        self._known = None
+
+    # Отсоединяем (или удаляем) секции целиком старше keep_months месяцев, считая текущий.
+    # Отсоединенная секция остается обычной таблицей, ее можно выгрузить в архив и удалить позже
+    def apply_retention(self, conn, keep_months, drop=False, now=None):
+        cutoff = add_months(datetime(*(now or datetime.now()).timetuple()[:2], 1), 1 - keep_months)
+        cur = conn.cursor()
+        removed = []
+        for month_start, name in sorted(self.list_partitions(cur).items()):
+            if month_start >= cutoff:
+                continue
+            cur.execute(f"ALTER TABLE {self.table} DETACH PARTITION {name}")
+            if drop:
+                cur.execute(f"DROP TABLE {name}")
+            removed.append(name)
+            logger.info(f"Секция {name} {'удалена' if drop else 'отсоединена'}")
+        conn.commit()
+        cur.close()
+        self.reset()
+        return removed
+
+# ------------------------------------------------------
+# Сводная таблица по пользователям и дням
+# ------------------------------------------------------
+
+# Дашборды читают маленькую training_daily_stats вместо сканирования всей истории.
+# Таблица обновляется из строк, реально вставленных пачкой, в той же транзакции
+DAILY_STATS = False
+
+DAILY_STATS_TABLE_QUERY = """
+CREATE TABLE training_daily_stats (
+    user_id {user_id_type} NOT NULL,
+    day DATE NOT NULL,
+    attempt_count INTEGER NOT NULL,
+    run_count INTEGER NOT NULL,
+    submit_count INTEGER NOT NULL,
+    correct_count INTEGER NOT NULL,
+    first_attempt_at TIMESTAMP NOT NULL,
+    last_attempt_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, day)
+)
+"""
+
+# Агрегаты по набору строк source (таблица или CTE с колонками training_data)
+DAILY_STATS_SELECT = """
+    SELECT user_id, created_at::date,
+           count(*),
+           count(*) FILTER (WHERE attempt_type = 'run'),
+           count(*) FILTER (WHERE attempt_type = 'submit'),
+           count(*) FILTER (WHERE is_correct),
+           min(created_at), max(created_at)
+    FROM {source}
+    GROUP BY user_id, created_at::date
+"""
+
+DAILY_STATS_COLUMNS = """(user_id, day, attempt_count, run_count, submit_count, correct_count,
+     first_attempt_at, last_attempt_at)"""
+
+# Перенос пачки из временной таблицы; дубликаты отсекает уникальное ограничение
+def staging_insert_query(columns):
+    column_list = ', '.join(columns)
+    return f"""
+        INSERT INTO training_data ({column_list})
+        SELECT {column_list} FROM training_data_staging
+        ON CONFLICT ON CONSTRAINT unique_user_attempt DO NOTHING"""
+
+# В RETURNING попадают только новые строки, поэтому повторная загрузка того же окна
+# не увеличивает счетчики сводной таблицы
+def daily_stats_insert_query(columns):
+    return """
+    WITH inserted AS (""" + staging_insert_query(columns) + """
+        RETURNING user_id, is_correct, attempt_type, created_at
+    ), daily AS (
+        INSERT INTO training_daily_stats AS s """ + DAILY_STATS_COLUMNS + """
+        """ + DAILY_STATS_SELECT.format(source='inserted') + """
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            attempt_count = s.attempt_count + EXCLUDED.attempt_count,
+            run_count = s.run_count + EXCLUDED.run_count,
+            submit_count = s.submit_count + EXCLUDED.submit_count,
+            correct_count = s.correct_count + EXCLUDED.correct_count,
+            first_attempt_at = LEAST(s.first_attempt_at, EXCLUDED.first_attempt_at),
+            last_attempt_at = GREATEST(s.last_attempt_at, EXCLUDED.last_attempt_at)
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM inserted), (SELECT count(*) FROM daily)
+    """
+
+# Создаем сводную таблицу; если история уже есть, один раз считаем ее полностью
+# Возвращает, вести ли сводную таблицу. Уже существующая таблица обновляется всегда, даже без
+# --daily-stats: иначе строки, загруженные без флага, в нее не попадут и она молча устареет
+def ensure_daily_stats_table(conn, cur, compact=False, create=False):
+    cur.execute("SELECT to_regclass('training_daily_stats') IS NOT NULL")
+    if cur.fetchone()[0]:
+        if not create:
+            logger.info("Найдена сводная таблица training_daily_stats, обновляем ее при загрузке")
+        return True
+    if not create:
+        return False
+
+    logger.info("Создаем сводную таблицу training_daily_stats по уже загруженным данным...")
+    cur.execute(DAILY_STATS_TABLE_QUERY.format(user_id_type='UUID' if compact else 'VARCHAR(32)'))
+    cur.execute("INSERT INTO training_daily_stats " + DAILY_STATS_COLUMNS +
+                DAILY_STATS_SELECT.format(source='training_data'))
+    logger.info(f"Сводная таблица создана, строк: {cur.rowcount}")
+    conn.commit()
+    return True
+
+# Загружаем одну пачку строк (кортежи в порядке CSV_FIELDNAMES) в training_data своей транзакцией.
+# Дубликаты отсекает сама база: COPY во временную таблицу, затем INSERT ... ON CONFLICT DO NOTHING,
+# поэтому стоимость загрузки зависит от размера пачки, а не от размера таблицы.
+# dimensions - пара справочников (ключи потребителя, адреса outcome) для компактной схемы
+def load_batch(conn, rows, metrics=None, partitions=None, daily_stats=False, dimensions=None,
+               copy_format=COPY_FORMAT):
+    metrics = metrics or PipelineMetrics()
+    cur = conn.cursor()
+    compact = dimensions is not None
+    columns = COMPACT_FIELDNAMES if compact else CSV_FIELDNAMES
+
+    if compact:
+        # Строки заменяем на id до COPY: во время COPY соединение занято
+        batch = list(rows)
+        consumer_keys, outcome_urls = dimensions
+        consumer_key_ids = consumer_keys.resolve(cur, (row[1] for row in batch))
+        outcome_url_ids = outcome_urls.resolve(cur, (row[3] for row in batch))
+        rows = ((row[0], consumer_key_ids.get(row[1]), row[2], outcome_url_ids.get(row[3]),
+                 row[4], row[5], row[6]) for row in batch)
+
+    # Временная таблица не пишется в WAL и удаляется при коммите
+    cur.execute(f"""
+        CREATE TEMP TABLE training_data_staging ({STAGING_COLUMNS[compact]}
+        ) ON COMMIT DROP
+    """)
+
+    counters = {'staged': 0}
+
+    def counted_rows():
+        for row in rows:
+            counters['staged'] += 1
+            yield row
+
+    with metrics.stage('copy') as stage:
+        if copy_format == 'binary':
+            copy_file = IteratorFile(iter_binary_copy(counted_rows(), BINARY_ENCODERS[compact]), binary=True)
+            copy_options = "(FORMAT binary)"
+        else:
+            copy_file = IteratorFile(iter_csv_lines(counted_rows()))
+            copy_options = "CSV"
+        cur.copy_expert(f"COPY training_data_staging ({', '.join(columns)}) FROM STDIN WITH {copy_options}",
+                        copy_file)
+        stage['records'] = counters['staged']
+        stage['bytes'] = copy_file.bytes_read
+
+    with metrics.stage('dedup') as stage:
+        # Секции под месяцы пачки создаются в той же транзакции, перед вставкой
+        if partitions is not None:
+            partitions.ensure_for_staging(cur)
+        if daily_stats:
+            cur.execute(daily_stats_insert_query(columns))
+            inserted, daily_rows = cur.fetchone()
+            metrics.increment('daily_stats_rows', daily_rows)
+        else:
+            cur.execute(staging_insert_query(columns))
+            inserted = cur.rowcount
+        skipped = counters['staged'] - inserted
+        stage['records'] = counters['staged']
+    metrics.increment('rows_inserted', inserted)
+    metrics.increment('rows_skipped', skipped)
+    
+    with metrics.stage('commit') as stage:
+        conn.commit()
+        stage['records'] = inserted
+    cur.close()
+    return inserted, skipped
+
+# Необязательные части схемы и формат COPY, включаются флагами запуска
+SCHEMA_DEFAULTS = {'partitioned': PARTITIONED, 'daily_stats': DAILY_STATS, 'compact': COMPACT_SCHEMA,
+                   'copy_format': COPY_FORMAT}
+
+# Пул соединений к одной базе. Схема проверяется один раз за процесс,
+# поэтому повторные загрузки пачек не платят ни за подключение, ни за запросы к каталогу
+class PostgresLoader:
+    def __init__(self, db_config, minconn=1, maxconn=4, schema=None):
+        import psycopg2.pool
+        logger.info("Подключаемся к PostgreSQL")
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **db_config)
+        logger.info("Подключение к PostgreSQL успешно установлено")
+        self.schema = dict(SCHEMA_DEFAULTS, **(schema or {}))
+        self.partitions = None
+        self.dimensions = None
+        self.daily_stats = False
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+        self.rows_inserted = 0
+        self.rows_skipped = 0
+
+    # Берем соединение из пула; при ошибке откатываем транзакцию, прежде чем вернуть его
+    @contextmanager
+    def connection(self):
+        conn = self.pool.getconn()
+        try:
+            yield conn
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+                logger.info("Транзакция отменена (rollback)")
+            raise
+        finally:
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+    def ensure_schema(self, conn=None):
+        if self._schema_ready:
+            return
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            if conn is None:
+                with self.connection() as conn:
+                    self._ensure_schema(conn)
+            else:
+                self._ensure_schema(conn)
+            self._schema_ready = True
+
+    def _ensure_schema(self, conn):
+        cur = conn.cursor()
+        layout = ensure_training_table(conn, cur, self.schema['partitioned'], self.schema['compact'])
+        if layout['partitioned']:
+            self.partitions = MonthlyPartitions()
+        if layout['compact']:
+            self.dimensions = (DimensionCache('training_consumer_keys'), DimensionCache('training_outcome_urls'))
+        self.daily_stats = ensure_daily_stats_table(conn, cur, layout['compact'],
+                                                    create=self.schema['daily_stats'])
+        cur.close()
+        conn.commit()
+
+    # Загружаем одну пачку на соединении из пула
+    def load(self, rows, metrics=None, conn=None):
+        if conn is None:
+            with self.connection() as conn:
+                return self.load(rows, metrics, conn)
+        self.ensure_schema(conn)
+        try:
+            inserted, skipped = load_batch(conn, rows, metrics, self.partitions, self.daily_stats,
+                                           self.dimensions, self.schema['copy_format'])
+        except BaseException:
+            if self.partitions is not None:
+                self.partitions.reset()
+            raise
+        self.rows_inserted += inserted
+        self.rows_skipped += skipped
+        return inserted, skipped
+
+    # Оценка числа строк из статистики планировщика вместо полного COUNT(*).
+    # У секционированной таблицы складываем оценки секций.
+    # None, если ANALYZE/autovacuum по таблице еще не проходил
+    def estimated_rows(self):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT SUM(reltuples)::bigint FROM pg_class
+                WHERE reltuples >= 0
+                  AND (oid = to_regclass('training_data') AND relkind = 'r'
+                       OR oid IN (SELECT inhrelid FROM pg_inherits
+                                  WHERE inhparent = to_regclass('training_data')))
+            """)
+            row = cur.fetchone()
+            cur.close()
+            conn.commit()
+        if row is None or row[0] is None:
+            return None
+        return row[0]
+
+    # У несекционированной или еще не созданной таблицы секций нет, и удалять нечего
+    def apply_retention(self, keep_months, drop=False):
+        partitions = self.partitions or MonthlyPartitions()
+        with self.connection() as conn:
+            return partitions.apply_retention(conn, keep_months, drop)
+
+    def close(self):
+        if not self.pool.closed:
+            self.pool.closeall()
+            logger.info("Соединения с PostgreSQL закрыты")
+
+
+_postgres_loaders = {}
+_postgres_loaders_lock = threading.Lock()
+
+# Один загрузчик (и один пул) на каждую конфигурацию подключения в процессе
+# maxconn учитывается только при создании пула
+def get_postgres_loader(db_config, schema=None, maxconn=4):
+    key = tuple(sorted(db_config.items()))
+    with _postgres_loaders_lock:
+        loader = _postgres_loaders.get(key)
+        if loader is None or loader.pool.closed:
+            loader = PostgresLoader(db_config, maxconn=maxconn, schema=schema)
+            _postgres_loaders[key] = loader
+        return loader
+
+def close_postgres_loaders():
+    with _postgres_loaders_lock:
+        for loader in _postgres_loaders.values():
+            loader.close()
+        _postgres_loaders.clear()
+
+# Загружаем строки в training_data одной транзакцией
+def copy_rows_to_postgresql(rows, db_config, metrics=None, schema=None):
+    import psycopg2
+    metrics = metrics or PipelineMetrics()
+
+    try:
+        loader = get_postgres_loader(db_config, schema)
+
+        logger.info("Начинаем импорт записей в PostgreSQL...")
+        inserted, skipped = loader.load(rows, metrics)
+        logger.info(f"Пропущено дубликатов: {skipped}")
+
+        if inserted:
+            logger.info(f"Успешно импортировано {inserted} новых записей")
+            print(f"Импортировано {inserted} новых записей")
+        else:
+            logger.info("Нет новых записей для импорта")
+            print("ℹ Нет новых записей для импорта")
+
+        # Показываем итоговую статистику без полного прохода по таблице
+        total_estimate = loader.estimated_rows()
+        if total_estimate is not None:
+            logger.info(f"Всего записей в таблице (оценка pg_class): {total_estimate}")
+        else:
+            logger.info("Статистика по таблице еще не собрана, оценка числа записей недоступна")
+
+        logger.info("Импорт в базу успешно завершен")
+
+        return {'inserted': inserted, 'skipped': skipped}
+
+    except psycopg2.OperationalError as e:
+        logger.error(f"Ошибка подключения к PostgreSQL: {e}")
+        return False
+
+    except Exception as e:
         logger.error(f"Ошибка при импорте в PostgreSQL: {e}")
-        if conn:
-            conn.rollback()
-            logger.info("Транзакция отменена (rollback)")
         return False
+
+# Хранение истории: старые месячные секции отсоединяем или удаляем целиком, без DELETE по строкам
+def apply_partition_retention(db_config, keep_months, drop=False):
+    import psycopg2
+
+    try:
+        removed = get_postgres_loader(db_config).apply_retention(keep_months, drop)
+        logger.info(f"Хранение секций: оставлено {keep_months} мес., обработано секций: {len(removed)}")
+        return removed
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка при обработке старых секций: {e}")
+        return False
+
+# Загружаем валидные записи напрямую из памяти, без CSV
+def load_records_to_postgresql(valid_records, db_config, metrics=None, schema=None):
+    logger.info("Начинаем загрузку данных в POSTGRESQL")
+    return copy_rows_to_postgresql((record.as_row() for record in valid_records), db_config, metrics,
+                                   schema)
+
+# Импорт ранее выгруженного CSV файла в базу
+def import_csv_to_postgresql(csv_file_path, db_config, schema=None):
+    logger.info("Начинаем импортировать данные в POSTGRESQL")
+    csv_path = Path(csv_file_path)
+
+    if not csv_path.exists():
+        logger.error(f"CSV файл не найден: {csv_path}")
+        print(f"CSV файл не найден: {csv_path}")
+        return False
+
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        csv_reader = csv.DictReader(f)
+        rows = (tuple(row[field] for field in CSV_FIELDNAMES) for row in csv_reader)
+        return copy_rows_to_postgresql(rows, db_config, schema=schema)
+
+# ------------------------------------------------------
+# Потоковое чтение training_data
+# ------------------------------------------------------
+
+# Порядок колонок в строках, которые отдает TrainingDataReader
+READ_COLUMNS = ['id'] + CSV_FIELDNAMES
+
+# Строки читаются пачками фиксированного размера, без fetchall всего диапазона, и всегда
+# упорядочены по (created_at, id). Ключ последней отданной строки хранится в last_key:
+# выгрузку можно продолжить с него после обрыва (after=last_key)
+class TrainingDataReader:
+    # Одинаковые колонки для обеих схем; в компактной строки собираются из справочников
+    PLAIN_SELECT = """
+        SELECT d.id, d.user_id, d.oauth_consumer_key, d.lis_result_sourcedid,
+               d.lis_outcome_service_url, d.is_correct, d.attempt_type, d.created_at
+        FROM training_data d
+    """
+    COMPACT_SELECT = """
+        SELECT d.id, replace(d.user_id::text, '-', ''), k.value, d.lis_result_sourcedid,
+               u.value, d.is_correct, d.attempt_type::text, d.created_at
+        FROM training_data d
+        LEFT JOIN training_consumer_keys k ON k.id = d.consumer_key_id
+        LEFT JOIN training_outcome_urls u ON u.id = d.outcome_url_id
+    """
+
+    def __init__(self, db_config, batch_size=10000):
+        self.db_config = db_config
+        self.batch_size = batch_size
+        self.last_key = None
+        self._cursor_number = 0
+
+    # Фильтры по исходным колонкам, чтобы работали индексы (в компактной схеме uuid
+    # принимает те же 32 hex-символа)
+    def build_query(self, compact, user_id=None, start=None, end=None, after=None, limit=None):
+        conditions = []
+        query_params = []
+        if user_id is not None:
+            conditions.append("d.user_id = %s")
+            query_params.append(user_id)
+        if start is not None:
+            conditions.append("d.created_at >= %s")
+            query_params.append(start)
+        if end is not None:
+            conditions.append("d.created_at <= %s")
+            query_params.append(end)
+        if after is not None:
+            conditions.append("(d.created_at, d.id) > (%s, %s)")
+            query_params.extend(after)
+
+        query = self.COMPACT_SELECT if compact else self.PLAIN_SELECT
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY d.created_at, d.id"
+        if limit is not None:
+            query += " LIMIT %s"
+            query_params.append(limit)
+        return query, query_params
+
+    @contextmanager
+    def _connection(self):
+        loader = get_postgres_loader(self.db_config)
+        with loader.connection() as conn:
+            try:
+                cur = conn.cursor()
+                layout = training_table_layout(cur)
+                cur.close()
+                if layout is None:
+                    raise Exception("Таблица training_data не найдена")
+                yield conn, layout['compact']
+            finally:
+                # Чтение ничего не меняет, просто закрываем транзакцию
+                conn.rollback()
+
+    # Один запрос через именованный (серверный) курсор: база отдает строки по batch_size,
+    # в памяти клиента одновременно только одна пачка. Транзакция открыта до конца чтения
+    def iter_batches(self, user_id=None, start=None, end=None, after=None):
+        with self._connection() as (conn, compact):
+            query, query_params = self.build_query(compact, user_id, start, end, after)
+            self._cursor_number += 1
+            cur = conn.cursor(name=f"training_reader_{os.getpid()}_{self._cursor_number}")
+            cur.itersize = self.batch_size
+            try:
+                cur.execute(query, query_params)
+                while True:
+                    rows = cur.fetchmany(self.batch_size)
+                    if not rows:
+                        break
+                    self.last_key = (rows[-1][7], rows[-1][0])
+                    yield rows
+            finally:
+                cur.close()
+
+    # Keyset-пагинация: каждая страница - отдельный короткий запрос от ключа предыдущей,
+    # долгой транзакции нет, и выгрузку можно прервать и продолжить в любой момент.
+    # Секционированным таблицам, созданным без индекса (created_at, id), нужен --migrate-keyset-index
+    def iter_pages(self, user_id=None, start=None, end=None, after=None):
+        while True:
+            with self._connection() as (conn, compact):
+                query, query_params = self.build_query(compact, user_id, start, end, after, self.batch_size)
+                cur = conn.cursor()
+                cur.execute(query, query_params)
+                rows = cur.fetchall()
+                cur.close()
+            if not rows:
+                return
+            after = self.last_key = (rows[-1][7], rows[-1][0])
+            yield rows
+            if len(rows) < self.batch_size:
+                return
+
+    # Пачки в колоночном виде: 'arrow' - pyarrow.Table, 'numpy' - словарь массивов NumPy
+    def iter_columns(self, output='arrow', keyset=False, **filters):
+        batches = self.iter_pages(**filters) if keyset else self.iter_batches(**filters)
+        for rows in batches:
+            columns = dict(zip(READ_COLUMNS, (list(values) for values in zip(*rows))))
+            if output == 'arrow':
+                pa = _import_pyarrow()
+                yield pa.table(arrow_arrays(pa, columns))
+            elif output == 'numpy':
+                yield numpy_columns(columns)
+            else:
+                raise ValueError(f"Неизвестный формат колонок: {output}")
+
+def _import_numpy():
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        raise ImportError("Для колонок NumPy нужен numpy: pip install numpy")
+
+# id и created_at - числовые массивы; текст и is_correct (может быть NULL) - object
+def numpy_columns(columns):
+    np = _import_numpy()
+    arrays = {}
+    for field, values in columns.items():
+        if field == 'id':
+            arrays[field] = np.array(values, dtype=np.int64)
+        elif field == 'created_at':
+            arrays[field] = np.array(values, dtype='datetime64[us]')
+        else:
+            arrays[field] = np.array(values, dtype=object)
+    return arrays
+
+# ------------------------------------------------------
+# Конвейерный режим: скачивание, валидация и загрузка идут одновременно
+# ------------------------------------------------------
+
+# Этапы работают в своих потоках и связаны очередями ограниченного размера:
+# если загрузка не успевает, валидация и скачивание ждут (backpressure)
+class PipelineCancelled(Exception):
+    pass
+
+
+class PipelinedRun:
+    _DONE = object()
+
+    def __init__(self, fetcher, validator, db_config, metrics=None, batch_size=5000,
+                 queue_size=4, workers=1, schema=None):
+        self.fetcher = fetcher
+        self.validator = validator
+        self.db_config = db_config
+        self.schema = schema
+        self.metrics = metrics or PipelineMetrics()
+        self.batch_size = batch_size
+        self.workers = workers
+        self.raw_queue = queue.Queue(maxsize=queue_size)
+        self.valid_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.result = {'inserted': 0, 'skipped': 0, 'batches': 0}
+
+    # Кладем в очередь, но регулярно проверяем, не отменен ли запуск
+    def _put(self, target_queue, item):
+        while not self.stop_event.is_set():
+            try:
+                target_queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        raise PipelineCancelled()
+
+    def _iter_queue(self, source_queue):
+        while True:
+            try:
+                item = source_queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    raise PipelineCancelled()
+                continue
+            if item is self._DONE:
+                return
+            yield item
+
+    # Обертка потока: первая ошибка останавливает все этапы
+    def _run_stage(self, name, target, *args):
+        try:
+            target(*args)
+        except PipelineCancelled:
+            pass
+        except BaseException as e:
+            logger.error(f"Ошибка на этапе {name}: {e}")
+            self.errors.append(e)
+            self.stop_event.set()
+
+    def _fetch(self, params):
+        batches = self.fetcher.iter_batches(params, self.batch_size)
+        try:
+            for batch in batches:
+                self._put(self.raw_queue, batch)
+        finally:
+            # Закрываем генератор, чтобы освободить HTTP-соединение при отмене
+            batches.close()
+        self._put(self.raw_queue, self._DONE)
+
+    def _validate(self):
+        raw_batches = self._iter_queue(self.raw_queue)
+        if self.workers > 1:
+            # Время валидации тратят рабочие процессы, здесь учитываем только записи
+            validated = self.validator.iter_process_parallel(raw_batches, self.workers)
+        else:
+            validated = (self._validate_batch(batch) for batch in raw_batches)
+
+        for valid_records in validated:
+            if valid_records:
+                self._put(self.valid_queue, valid_records)
+        self._put(self.valid_queue, self._DONE)
+
+    def _validate_batch(self, batch):
+        with self.metrics.stage('validate') as stage:
+            stage['records'] = len(batch)
+            return self.validator.process_batch(batch)
+
+    # Каждая пачка загружается и коммитится отдельно
+    def _load(self):
+        loader = get_postgres_loader(self.db_config, self.schema)
+        # Одно соединение из пула на весь запуск, каждая пачка коммитится отдельно
+        with loader.connection() as conn:
+            for valid_records in self._iter_queue(self.valid_queue):
+                inserted, skipped = loader.load((record.as_row() for record in valid_records),
+                                                self.metrics, conn)
+                self.result['inserted'] += inserted
+                self.result['skipped'] += skipped
+                self.result['batches'] += 1
+                logger.info(f"Пачка {self.result['batches']}: импортировано {inserted}, "
+                            f"пропущено дубликатов {skipped}")
+
+    def run(self, params):
+        logger.info(f"Конвейерный режим: пачки по {self.batch_size} записей, очередь {self.raw_queue.maxsize}")
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(target=self._run_stage, args=('fetch', self._fetch, params), name='etl-fetch'),
+            threading.Thread(target=self._run_stage, args=('validate', self._validate), name='etl-validate'),
+            threading.Thread(target=self._run_stage, args=('load', self._load), name='etl-load'),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            logger.warning("Получен сигнал остановки, завершаем этапы...")
+            self.stop_event.set()
+            for thread in threads:
+                thread.join()
+            raise
+
+        if self.errors:
+            raise self.errors[0]
+
+        if self.workers > 1:
+            self.metrics.add('validate', time.perf_counter() - started,
+                             records=self.validator.statistics['total_records'])
+        logger.info(f"Конвейер завершен: пачек {self.result['batches']}, импортировано "
+                    f"{self.result['inserted']}, пропущено дубликатов {self.result['skipped']}")
+        return {'inserted': self.result['inserted'], 'skipped': self.result['skipped']}
+
+# ------------------------------------------------------
+# Дозагрузка истории (backfill) окнами переменного размера
+# ------------------------------------------------------
+
+# Размер ответа за окно отличается на порядки между тихими и загруженными днями.
+# Окно подстраивается под целевое число записей и время ответа, а завершенные окна
+# сохраняются после коммита, поэтому прерванная дозагрузка продолжает только недостающие
+BACKFILL_CONFIG = {
+    'target_records': 50000,
+    'target_seconds': 60,
+    'min_window': timedelta(minutes=5),
+    'max_window': timedelta(days=7),
+    'max_growth': 4.0,
+}
+
+class BackfillPlanner:
+    def __init__(self, state_file, client, start: str, end: str, initial_window=timedelta(hours=12),
+                 target_records=BACKFILL_CONFIG['target_records'],
+                 target_seconds=BACKFILL_CONFIG['target_seconds'],
+                 min_window=BACKFILL_CONFIG['min_window'], max_window=BACKFILL_CONFIG['max_window'],
+                 max_growth=BACKFILL_CONFIG['max_growth']):
+        self.state_file = Path(state_file)
+        self.client = client
+        self.start = datetime.strptime(start, DATE_FORMAT)
+        self.end = datetime.strptime(end, DATE_FORMAT)
+        self.target_records = target_records
+        self.target_seconds = target_seconds
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_growth = max_growth
+
+        state = self._load_state().get(client, {})
+        # Завершенные интервалы [начало, конец] включительно, отсортированные и склеенные
+        self.completed = [(datetime.strptime(s, DATE_FORMAT), datetime.strptime(e, DATE_FORMAT))
+                          for s, e in state.get('completed', [])]
+        # Размер окна, подобранный в прошлый раз, полезнее первоначальной догадки
+        window_seconds = state.get('window_seconds')
+        self.window = timedelta(seconds=window_seconds) if window_seconds else initial_window
+        self.window = min(max(self.window, self.min_window), self.max_window)
+
+    def _load_state(self) -> Dict:
+        if not self.state_file.exists():
+            return {}
+        with open(self.state_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    # Как и watermark, пишем через временный файл
+    def save(self):
+        state = self._load_state()
+        state[self.client] = {
+            'completed': [[s.strftime(DATE_FORMAT), e.strftime(DATE_FORMAT)] for s, e in self.completed],
+            'window_seconds': self.window.total_seconds(),
+        }
+        tmp_file = self.state_file.with_name(self.state_file.name + '.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.state_file)
+
+    # Незагруженные промежутки внутри start-end: (начало, конец включительно)
+    def missing_ranges(self) -> List[Tuple[datetime, datetime]]:
+        step = timedelta(microseconds=1)
+        ranges = []
+        cursor = self.start
+        for done_start, done_end in self.completed:
+            if done_end < cursor:
+                continue
+            if done_start > self.end:
+                break
+            if done_start > cursor:
+                ranges.append((cursor, done_start - step))
+            cursor = done_end + step
+        if cursor <= self.end:
+            ranges.append((cursor, self.end))
+        return ranges
+
+    # Следующее окно в первом незагруженном промежутке; None, если все загружено.
+    # Конец окна, как и в split_range, на микросекунду раньше начала следующего
+    def next_window(self) -> Optional[Tuple[str, str]]:
+        missing = self.missing_ranges()
+        if not missing:
+            return None
+        gap_start, gap_end = missing[0]
+        next_start = gap_start + self.window
+        window_end = gap_end if next_start > gap_end else next_start - timedelta(microseconds=1)
+        return gap_start.strftime(DATE_FORMAT), window_end.strftime(DATE_FORMAT)
+
+    def remaining(self) -> timedelta:
+        return sum((end - start for start, end in self.missing_ranges()), timedelta())
+
+    # Отмечаем окно загруженным и подбираем размер следующего по плотности записей и времени ответа
+    def record(self, start: str, end: str, records: int, seconds: float):
+        start_dt = datetime.strptime(start, DATE_FORMAT)
+        end_dt = datetime.strptime(end, DATE_FORMAT)
+        self._add_completed(start_dt, end_dt)
+
+        span = end_dt - start_dt + timedelta(microseconds=1)
+        factor = self.max_growth
+        if records:
+            factor = min(factor, self.target_records / records)
+        if self.target_seconds and seconds > 0:
+            factor = min(factor, self.target_seconds / seconds)
+        # Окно, обрезанное концом промежутка, не повод уменьшать размер
+        if not (factor >= 1 and span < self.window):
+            window = timedelta(seconds=round((span * factor).total_seconds()))
+            self.window = min(max(window, self.min_window), self.max_window)
+        self.save()
+
+    # Окно не скачалось даже после повторов (таймаут, 5xx на загруженном дне): уменьшаем его вдвое,
+    # не меньше min_window, и сохраняем, чтобы и следующий запуск не начинал с того же окна.
+    # False, если уменьшать уже некуда
+    def shrink(self, start: str, end: str) -> bool:
+        span = datetime.strptime(end, DATE_FORMAT) - datetime.strptime(start, DATE_FORMAT) \
+            + timedelta(microseconds=1)
+        if span <= self.min_window:
+            return False
+        self.window = max(timedelta(seconds=round(span.total_seconds() / 2)), self.min_window)
+        self.save()
+        return True
+
+    def _add_completed(self, start: datetime, end: datetime):
+        step = timedelta(microseconds=1)
+        merged = []
+        for done_start, done_end in sorted(self.completed + [(start, end)]):
+            if merged and done_start <= merged[-1][1] + step:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], done_end))
+            else:
+                merged.append((done_start, done_end))
+        self.completed = merged
+
+
+# Окна идут по очереди: размер следующего зависит от результата предыдущего.
+# Каждое окно валидируется и загружается своей транзакцией, после коммита отмечается в плане
+def run_backfill(fetcher, validator, db_config, planner, params, metrics=None, schema=None):
+    metrics = metrics or PipelineMetrics()
+    loader = get_postgres_loader(db_config, schema)
+    result = {'inserted': 0, 'skipped': 0, 'windows': 0}
+    logger.info(f"Дозагрузка {planner.start} - {planner.end}: осталось загрузить {planner.remaining()}, "
+                f"начальное окно {planner.window}")
+
+    with loader.connection() as conn:
+        while True:
+            window = planner.next_window()
+            if window is None:
+                break
+            start, end = window
+
+            started = time.perf_counter()
+            try:
+                raw_data = fetcher.fetch_window(params, start, end)
+            except Exception as e:
+                if not planner.shrink(start, end):
+                    raise
+                logger.warning(f"Окно {start} - {end} не загружено ({e}), уменьшаем окно до {planner.window}")
+                continue
+            seconds = time.perf_counter() - started
+
+            valid_records = []
+            for batch in iter_chunks(raw_data, validator.batch_size):
+                with metrics.stage('validate') as stage:
+                    stage['records'] = len(batch)
+                    valid_records.extend(validator.process_batch(batch))
+
+            inserted, skipped = loader.load((record.as_row() for record in valid_records), metrics, conn)
+            planner.record(start, end, len(raw_data), seconds)
+
+            result['inserted'] += inserted
+            result['skipped'] += skipped
+            result['windows'] += 1
+            logger.info(f"Окно {start} - {end}: записей {len(raw_data)} за {seconds:.1f} с, "
+                        f"импортировано {inserted}, следующее окно {planner.window}")
+
+    logger.info(f"Дозагрузка завершена: окон {result['windows']}, импортировано {result['inserted']}, "
+                f"пропущено дубликатов {result['skipped']}")
+    return result
+
+# ------------------------------------------------------
+# Несколько клиентов API в одном процессе
+# ------------------------------------------------------
+
+# Файл клиентов - JSON-список: [{"client": "...", "client_key": "...", "max_concurrency": 2}, ...].
+# Вместо client_key можно указать client_key_env - имя переменной окружения с ключом
+def load_clients(clients_file) -> List[Dict]:
+    with open(clients_file, 'r', encoding='utf-8') as f:
+        clients = json.load(f)
+
+    for client in clients:
+        if 'client_key_env' in client:
+            client['client_key'] = os.environ.get(client['client_key_env'])
+        if not client.get('client') or not client.get('client_key'):
+            raise ValueError(f"У клиента не указан client или client_key: {client.get('client')}")
+    if len({client['client'] for client in clients}) != len(clients):
+        raise ValueError("Имена клиентов в файле должны быть уникальны")
+    return clients
+
+# Состояние одного клиента: свои окна, валидатор, ошибки, метрики и watermark.
+# Окна одного клиента могут обрабатываться параллельно, не больше max_concurrency сразу
+class ClientJob:
+    def __init__(self, params, fetcher, validator, error_sink, metrics, max_concurrency=1):
+        self.client = params['client']
+        self.params = params
+        self.fetcher = fetcher
+        self.validator = validator
+        self.error_sink = error_sink
+        self.metrics = metrics
+        self.max_concurrency = max_concurrency
+        self.windows = deque()
+        self.in_flight = 0
+        self.error = None
+        self.result = {'inserted': 0, 'skipped': 0, 'windows': 0}
+        # Валидатор и файл ошибок клиента не потокобезопасны
+        self._lock = threading.Lock()
+
+    def can_submit(self):
+        return self.error is None and self.windows and self.in_flight < self.max_concurrency
+
+    def fail(self, error):
+        self.error = error
+        self.windows.clear()
+        logger.error(f"Клиент {self.client}: ошибка, оставшиеся окна пропущены: {error}")
+
+    # Окно целиком: скачивание, валидация и загрузка своей транзакцией
+    def process_window(self, start, end, loader, process_pool=None):
+        raw_data = self.fetcher.fetch_window(self.params, start, end)
+
+        with self.metrics.stage('validate') as stage:
+            stage['records'] = len(raw_data)
+            if process_pool is not None:
+                # Тяжелая работа идет в общих рабочих процессах, здесь только слияние результата
+                chunk_result = process_pool.submit(_validate_chunk, raw_data).result()
+                with self._lock:
+                    valid_records = self.validator._merge_chunk_result(chunk_result)
+            else:
+                with self._lock:
+                    valid_records = []
+                    for batch in iter_chunks(raw_data, self.validator.batch_size):
+                        valid_records.extend(self.validator.process_batch(batch))
+
+        inserted, skipped = loader.load((record.as_row() for record in valid_records), self.metrics)
+        with self._lock:
+            self.result['inserted'] += inserted
+            self.result['skipped'] += skipped
+            self.result['windows'] += 1
+        logger.info(f"Клиент {self.client}, окно {start} - {end}: записей {len(raw_data)}, "
+                    f"импортировано {inserted}, пропущено дубликатов {skipped}")
+
+
+# Окна всех клиентов раздаются общему пулу потоков по кругу, с учетом лимита каждого клиента.
+# HTTP-сессия, пул соединений к базе и процессы валидации общие на весь запуск
+class MultiClientRun:
+    def __init__(self, jobs, db_config, schema=None, workers=8, validation_workers=1, batch_size=5000):
+        self.jobs = jobs
+        self.db_config = db_config
+        self.schema = schema
+        self.workers = workers
+        self.validation_workers = validation_workers
+        self.batch_size = batch_size
+
+    def _submit_ready(self, executor, pending, loader, process_pool):
+        submitted = True
+        while submitted and len(pending) < self.workers:
+            submitted = False
+            for job in self.jobs:
+                if len(pending) >= self.workers:
+                    break
+                if job.can_submit():
+                    start, end = job.windows.popleft()
+                    job.in_flight += 1
+                    future = executor.submit(job.process_window, start, end, loader, process_pool)
+                    pending[future] = job
+                    submitted = True
+
+    def run(self):
+        loader = get_postgres_loader(self.db_config, self.schema, maxconn=self.workers)
+        loader.ensure_schema()
+
+        for job in self.jobs:
+            try:
+                job.windows.extend(job.fetcher.windows(job.params))
+            except Exception as e:
+                job.fail(e)
+            logger.info(f"Клиент {job.client}: окон {len(job.windows)}, "
+                        f"одновременно не больше {job.max_concurrency}")
+
+        process_pool = None
+        if self.validation_workers > 1 and self.jobs:
+            from concurrent.futures import ProcessPoolExecutor
+            process_pool = ProcessPoolExecutor(max_workers=self.validation_workers,
+                                               initializer=_init_validation_worker,
+                                               initargs=(self.batch_size,
+                                                         self.jobs[0].validator.passback_cache.maxsize))
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='etl-client') as executor:
+                pending = {}
+                self._submit_ready(executor, pending, loader, process_pool)
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job = pending.pop(future)
+                        job.in_flight -= 1
+                        try:
+                            future.result()
+                        except Exception as e:
+                            job.fail(e)
+                    self._submit_ready(executor, pending, loader, process_pool)
+        finally:
+            if process_pool is not None:
+                process_pool.shutdown()
+
+        return {job.client: job.result for job in self.jobs}
+
+# Запуск по списку клиентов: у каждого свой watermark в общем state.json, свои ошибки и метрики
+def run_clients(args, db_config, schema):
+    try:
+        clients = load_clients(args.clients_file)
+    except (OSError, ValueError) as e:
+        logger.error(f"Не удалось прочитать список клиентов: {str(e)}")
+        return 1
+    state_file = Path(args.state_file) if args.state_file else project_root / 'state.json'
+    metrics_dir = Path(args.metrics_dir) if args.metrics_dir else project_root
+    if args.export_csv or args.export_format or args.pipelined or args.backfill:
+        logger.warning("В режиме нескольких клиентов выгрузки, конвейер и backfill не используются")
+
+    response_cache = None
+    if args.cache or args.replay:
+        response_cache = ResponseCache(Path(args.cache_dir) if args.cache_dir else project_root / 'api_cache',
+                                       max_bytes=int(args.cache_max_mb * 1024 ** 2),
+                                       max_age=timedelta(days=args.cache_max_age_days))
+
+    # Одна keep-alive сессия на всех клиентов, пул соединений по общему числу потоков
+    session = None
+    if not args.replay:
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=args.fetch_workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    jobs = []
+    for client in clients:
+        base_params = dict(params, client=client['client'], client_key=client['client_key'],
+                           start=client.get('start', args.start), end=client.get('end', args.end))
+        if args.incremental:
+            run_params = incremental_params(base_params, state_file, timedelta(hours=args.overlap_hours))
+        else:
+            run_params = base_params
+
+        metrics = PipelineMetrics(labels={'client': client['client']})
+        fetcher = ApiFetcher(logger, api_url=client.get('api_url', args.api_url),
+                             window=timedelta(hours=args.window_hours), max_workers=1,
+                             max_retries=FETCH_CONFIG['max_retries'],
+                             backoff_factor=FETCH_CONFIG['backoff_factor'], timeout=FETCH_CONFIG['timeout'],
+                             metrics=metrics, cache=response_cache, replay=args.replay, session=session)
+        safe_name = re.sub(r'[^\w.-]', '_', client['client'])
+        error_sink = ErrorSink(project_root / f"errors_{safe_name}_{datetime.now().strftime('%Y%m%d')}.jsonl")
+        validator = RecordValidator(logger, batch_size=args.batch_size, error_sink=error_sink)
+        jobs.append(ClientJob(run_params, fetcher, validator, error_sink, metrics,
+                              max_concurrency=client.get('max_concurrency', args.client_concurrency)))
+        logger.info(f"Клиент {client['client']}: период {run_params['start']} - {run_params['end']}")
+
+    run = MultiClientRun(jobs, db_config, schema, workers=args.fetch_workers,
+                         validation_workers=args.workers, batch_size=args.batch_size)
+    try:
+        run.run()
+    except Exception as e:
+        # Например, база недоступна: метрики все равно пишем, всем клиентам без ошибки ставим эту
+        logger.error(f"Ошибка при загрузке клиентов: {str(e)}")
+        for job in jobs:
+            if job.error is None:
+                job.error = e
     finally:
-        if conn:
-            conn.close()
-            logger.info("Соединение с PostgreSQL закрыто")
+        for job in jobs:
+            job.fetcher.close()
+            job.error_sink.close()
+        if session is not None:
+            session.close()
+        close_postgres_loaders()
 
-if csv_file_path:
-    imported_count = import_csv_to_postgresql(csv_file_path, DB_CONFIG)
+    summary = {}
+    for job in jobs:
+        safe_name = re.sub(r'[^\w.-]', '_', job.client)
+        job.validator.save_errors(filename=f"errors_{safe_name}_{datetime.now().strftime('%Y%m%d')}.txt",
+                                  file_path=project_root)
+        job.metrics.increment('passback_cache_hits', job.validator.passback_cache.hits)
+        job.metrics.increment('passback_cache_misses', job.validator.passback_cache.misses)
+        job.metrics.increment('invalid_records', job.validator.statistics['invalid_records'])
+        job.metrics.success = job.error is None
 
-    if imported_count is not False:
-        logger.info("Процесс успешно завершен")
-        print("Процесс успешно завершен")
+        # Watermark сдвигаем только клиентам, у которых все окна загружены
+        if job.error is None and args.incremental:
+            save_watermark(state_file, job.client, job.params['end'])
+            logger.info(f"Клиент {job.client}: watermark сохранен: {job.params['end']}")
+
+        job.metrics.write_prometheus(metrics_dir / f"metrics_{safe_name}.prom")
+        summary[job.client] = dict(job.metrics.summary(), result=job.result)
+        logger.info(f"Клиент {job.client}: импортировано {job.result['inserted']}, "
+                    f"пропущено дубликатов {job.result['skipped']}, окон {job.result['windows']}"
+                    + ("" if job.error is None else f", ошибка: {job.error}"))
+
+    _atomic_write(metrics_dir / 'run_summary.json', json.dumps({'clients': summary}, ensure_ascii=False,
+                                                               indent=2, default=str))
+    failed = [job.client for job in jobs if job.error is not None]
+    if failed:
+        logger.error(f"Завершено с ошибками у клиентов: {', '.join(failed)}")
+        return 1
+    logger.info("Процесс успешно завершен")
+    print("Процесс успешно завершен")
+    return 0
+
+# ------------------------------------------------------
+# Запуск всего процесса
+# ------------------------------------------------------
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Загрузка данных из API Itresume в PostgreSQL")
+
+    api = parser.add_argument_group("API")
+    api.add_argument('--api-url', default=API_URL)
+    api.add_argument('--client', default=params['client'])
+    api.add_argument('--client-key', default=params['client_key'])
+    api.add_argument('--start', default=params['start'], help=f"начало периода, формат {DATE_FORMAT!r}")
+    api.add_argument('--end', help=f"конец периода (по умолчанию {params['end']}, "
+                                   f"в инкрементальном режиме - сейчас)")
+    api.add_argument('--clients-file', help="JSON-список клиентов для загрузки в одном процессе "
+                                            "(client, client_key или client_key_env, max_concurrency)")
+    api.add_argument('--client-concurrency', type=int, default=2,
+                     help="сколько окон одного клиента обрабатывается одновременно (по умолчанию)")
+    api.add_argument('--window-hours', type=float, default=FETCH_CONFIG['window'].total_seconds() / 3600,
+                     help="размер окна одного запроса")
+    api.add_argument('--fetch-workers', type=int, default=FETCH_CONFIG['max_workers'],
+                     help="число одновременных запросов")
+    api.add_argument('--no-streaming', dest='streaming', action='store_false', default=STREAMING,
+                     help="скачать ответ целиком вместо потокового разбора")
+    api.add_argument('--pipelined', action='store_true',
+                     help="скачивать, валидировать и загружать пачки одновременно, с коммитом каждой пачки")
+    api.add_argument('--queue-size', type=int, default=4,
+                     help="сколько пачек может ждать между этапами в конвейерном режиме")
+
+    cache = parser.add_argument_group("Кэш ответов API")
+    cache.add_argument('--cache', action='store_true', default=API_CACHE,
+                       help="сохранять ответы API за завершенные окна и брать их из кэша при повторе")
+    cache.add_argument('--replay', action='store_true',
+                       help="взять данные только из кэша, без обращения к сети (watermark не сдвигается)")
+    cache.add_argument('--cache-dir', help="папка кэша (по умолчанию api_cache в папке проекта)")
+    cache.add_argument('--cache-max-mb', type=float, default=CACHE_CONFIG['max_bytes'] / 1024 ** 2)
+    cache.add_argument('--cache-max-age-days', type=float, default=CACHE_CONFIG['max_age'].days)
+
+    backfill = parser.add_argument_group("Дозагрузка истории")
+    backfill.add_argument('--backfill', action='store_true',
+                          help="загрузить --start/--end окнами переменного размера с продолжением после обрыва")
+    backfill.add_argument('--target-records', type=int, default=BACKFILL_CONFIG['target_records'],
+                          help="желаемое число записей в ответе за одно окно")
+    backfill.add_argument('--target-seconds', type=float, default=BACKFILL_CONFIG['target_seconds'],
+                          help="желаемое время ответа за одно окно")
+    backfill.add_argument('--backfill-state', help="файл с завершенными окнами "
+                                                   "(по умолчанию backfill_state.json в папке проекта)")
+
+    incremental = parser.add_argument_group("Инкрементальный режим")
+    incremental.add_argument('--incremental', dest='incremental', action='store_true', default=INCREMENTAL,
+                             help="начать с сохраненного watermark и загрузить все до текущего момента")
+    incremental.add_argument('--no-incremental', dest='incremental', action='store_false',
+                             help="загрузить ровно период --start/--end без watermark")
+    incremental.add_argument('--overlap-hours', type=float,
+                             default=WATERMARK_OVERLAP.total_seconds() / 3600,
+                             help="перекрытие с предыдущим запуском для опоздавших записей")
+    incremental.add_argument('--state-file', help="файл с watermark (по умолчанию state.json в папке проекта)")
+
+    validation = parser.add_argument_group("Валидация")
+    validation.add_argument('--workers', type=int, default=VALIDATION_CONFIG['workers'],
+                            help="число процессов валидации")
+    validation.add_argument('--chunk-size', type=int, default=VALIDATION_CONFIG['chunk_size'])
+    validation.add_argument('--batch-size', type=int, default=VALIDATION_CONFIG['batch_size'])
+
+    paths = parser.add_argument_group("Файлы")
+    paths.add_argument('--base-path', default=str(BASE_PATH), help="где создать папку проекта")
+    paths.add_argument('--project-name', default=PROJECT_NAME)
+    paths.add_argument('--export-csv', action='store_true', default=EXPORT_CSV,
+                       help="дополнительно сохранить валидные записи в CSV")
+    paths.add_argument('--export-format', choices=sorted(EXPORT_FORMATS),
+                       help="дополнительно сохранить валидные записи в Parquet или Arrow IPC (нужен pyarrow)")
+    paths.add_argument('--export-compression', default='zstd',
+                       help="сжатие колоночной выгрузки (zstd, lz4, snappy для Parquet, ...)")
+    paths.add_argument('--export-partition-by-date', action='store_true',
+                       help="разложить колоночную выгрузку по каталогам created_date=YYYY-MM-DD")
+
+    monitoring = parser.add_argument_group("Метрики")
+    monitoring.add_argument('--metrics-dir', help="куда писать metrics.prom и run_summary.json "
+                                                  "(по умолчанию папка проекта)")
+    monitoring.add_argument('--profile-stage', choices=PipelineMetrics.PROFILED_STAGES,
+                            help="снять профиль cProfile для одного этапа")
+
+    db = parser.add_argument_group("PostgreSQL")
+    db.add_argument('--db-host', default=DB_CONFIG['host'])
+    db.add_argument('--db-port', type=int, default=DB_CONFIG['port'])
+    db.add_argument('--db-name', default=DB_CONFIG['database'])
+    db.add_argument('--db-user', default=DB_CONFIG['user'])
+    db.add_argument('--db-password', default=os.environ.get('PGPASSWORD', DB_CONFIG['password']))
+    db.add_argument('--partitioned', action='store_true', default=PARTITIONED,
+                    help="создавать training_data с секциями по месяцам created_at")
+    db.add_argument('--copy-format', choices=['csv', 'binary'], default=COPY_FORMAT,
+                    help="формат COPY: текстовый CSV или бинарный (без разбора текста на сервере)")
+    db.add_argument('--compact-schema', action='store_true', default=COMPACT_SCHEMA,
+                    help="создавать training_data с uuid, enum и справочниками вместо повторяющегося текста")
+    db.add_argument('--daily-stats', action='store_true', default=DAILY_STATS,
+                    help="создать сводную таблицу training_daily_stats по пользователям и дням "
+                         "(существующая обновляется при каждой загрузке и без флага)")
+    db.add_argument('--retention-months', type=int,
+                    help="после загрузки отсоединить секции старше указанного числа месяцев")
+    db.add_argument('--retention-drop', action='store_true',
+                    help="удалять старые секции, а не отсоединять")
+    db.add_argument('--retention-only', action='store_true',
+                    help="только применить --retention-months, без загрузки данных")
+    db.add_argument('--migrate-keyset-index', action='store_true',
+                    help="только добавить индекс (created_at, id) в секционированную таблицу, созданную без него "
+                         "(строится по секциям CONCURRENTLY, без блокировки записи)")
+
+    args = parser.parse_args(argv)
+    # В инкрементальном режиме конец периода всегда текущий момент, явный --end молча потерялся бы
+    if args.incremental and args.end is not None:
+        parser.error("--end нельзя указывать вместе с --incremental")
+    if args.end is None:
+        args.end = params['end']
+    return args
+
+def main(argv=None):
+    global project_root
+    args = parse_args(argv)
+
+    project_root = create_project_directories(args.base_path, args.project_name)
+    setup_logging(project_root / 'logs')
+
+    db_config = {
+        'host': args.db_host,
+        'port': args.db_port,
+        'database': args.db_name,
+        'user': args.db_user,
+        'password': args.db_password
+    }
+    schema = {'partitioned': args.partitioned, 'daily_stats': args.daily_stats, 'compact': args.compact_schema,
+              'copy_format': args.copy_format}
+    if args.retention_only:
+        if not args.retention_months:
+            logger.error("Для --retention-only нужно указать --retention-months")
+            return 1
+        removed = apply_partition_retention(db_config, args.retention_months, args.retention_drop)
+        close_postgres_loaders()
+        return 0 if removed is not False else 1
+    if args.migrate_keyset_index:
+        return 0 if migrate_keyset_index(db_config) else 1
+
+    # Повтор из кэша и дозагрузка истории всегда идут ровно за --start/--end
+    if args.replay or args.backfill:
+        args.incremental = False
+
+    if args.clients_file:
+        return run_clients(args, db_config, schema)
+
+    base_params = dict(params, client=args.client, client_key=args.client_key, start=args.start, end=args.end)
+    state_file = Path(args.state_file) if args.state_file else project_root / 'state.json'
+
+    if args.incremental:
+        run_params = incremental_params(base_params, state_file, timedelta(hours=args.overlap_hours))
+    else:
+        run_params = base_params
+
+    metrics_dir = Path(args.metrics_dir) if args.metrics_dir else project_root
+    metrics = PipelineMetrics(labels={'client': run_params['client']}, profile_stage=args.profile_stage,
+                              profile_dir=metrics_dir)
+
+    response_cache = None
+    if args.cache or args.replay:
+        response_cache = ResponseCache(Path(args.cache_dir) if args.cache_dir else project_root / 'api_cache',
+                                       max_bytes=int(args.cache_max_mb * 1024 ** 2),
+                                       max_age=timedelta(days=args.cache_max_age_days))
+
+    load_result = False
+    try:
+        logger.info("===============================================")
+        logger.info(f"Начинаем скачивание данных из API за период {run_params['start']} - {run_params['end']}...")
+
+        fetcher = ApiFetcher(logger, api_url=args.api_url, window=timedelta(hours=args.window_hours),
+                             max_workers=args.fetch_workers, max_retries=FETCH_CONFIG['max_retries'],
+                             backoff_factor=FETCH_CONFIG['backoff_factor'], timeout=FETCH_CONFIG['timeout'],
+                             metrics=metrics, cache=response_cache, replay=args.replay)
+        error_sink = ErrorSink(project_root / f"errors_{datetime.now().strftime('%Y%m%d')}.jsonl")
+        validator = RecordValidator(logger, batch_size=args.batch_size, error_sink=error_sink)
+
+        if args.backfill:
+            if args.export_csv or args.export_format:
+                logger.warning("При дозагрузке истории CSV и колоночная выгрузка не сохраняются")
+            backfill_state = Path(args.backfill_state) if args.backfill_state \
+                else project_root / 'backfill_state.json'
+            planner = BackfillPlanner(backfill_state, run_params['client'], run_params['start'], run_params['end'],
+                                      initial_window=timedelta(hours=args.window_hours),
+                                      target_records=args.target_records, target_seconds=args.target_seconds)
+            try:
+                load_result = run_backfill(fetcher, validator, db_config, planner, run_params, metrics, schema)
+            except Exception as e:
+                # Завершенные окна уже отмечены, следующий запуск продолжит с недостающих
+                logger.error(f"Ошибка при дозагрузке истории: {str(e)}")
+                load_result = False
+            finally:
+                fetcher.close()
+                error_sink.close()
+            validator.save_errors(file_path=project_root)
+        elif args.pipelined:
+            if args.export_csv or args.export_format:
+                logger.warning("В конвейерном режиме CSV и колоночная выгрузка не сохраняются, "
+                               "записи сразу уходят в базу")
+            pipeline = PipelinedRun(fetcher, validator, db_config, metrics, batch_size=args.batch_size,
+                                    queue_size=args.queue_size, workers=args.workers,
+                                    schema=schema)
+            try:
+                load_result = pipeline.run(run_params)
+            except Exception as e:
+                # Уже закоммиченные пачки остаются в базе, watermark не сдвигается
+                logger.error(f"Ошибка в конвейерном режиме: {str(e)}")
+                load_result = False
+            finally:
+                fetcher.close()
+                error_sink.close()
+            validator.save_errors(file_path=project_root)
+        else:
+            try:
+                if args.streaming:
+                    # Записи будут скачиваться по мере валидации
+                    raw_data = fetcher.iter_records(run_params)
+                    logger.info("Потоковый режим: записи читаются из ответа API по мере валидации")
+                else:
+                    raw_data = fetcher.fetch(run_params)
+                    logger.info(f"Данные успешно загружены. Получено записей: {len(raw_data)}")
+
+                logger.info("Начинаем валидацию данных")
+                # В потоковом режиме сюда входит и чтение из сети, оно же отдельно учтено в fetch
+                with metrics.stage('validate') as stage:
+                    valid_records = validator.process_records(raw_data, workers=args.workers,
+                                                              chunk_size=args.chunk_size)
+                    stage['records'] = validator.statistics['total_records']
+
+            except Exception as e:
+                logger.error(f"Неожиданная ошибка при загрузке данных: {str(e)}")
+                raise
+            finally:
+                fetcher.close()
+                error_sink.close()
+
+            validator.save_errors(file_path=project_root)
+
+            # Дополнительно сохраняем данные в CSV
+            if args.export_csv:
+                with metrics.stage('csv') as stage:
+                    csv_file_path = save_to_csv(valid_records, 'training_data.csv', project_root)
+                    stage['records'] = len(valid_records)
+                    stage['bytes'] = csv_file_path.stat().st_size if csv_file_path else 0
+
+            if args.export_format:
+                with metrics.stage('export') as stage:
+                    exported = save_to_columnar(valid_records, args.export_format, project_root,
+                                                compression=args.export_compression,
+                                                partition_by_date=args.export_partition_by_date)
+                    stage['records'] = len(valid_records)
+                    stage['bytes'] = exported[1] if exported else 0
+
+            load_result = load_records_to_postgresql(valid_records, db_config, metrics, schema)
+
+        # Ошибка при обработке старых секций не отменяет уже загруженные данные и watermark
+        if load_result is not False and args.retention_months:
+            apply_partition_retention(db_config, args.retention_months, args.retention_drop)
+
+        metrics.increment('passback_cache_hits', validator.passback_cache.hits)
+        metrics.increment('passback_cache_misses', validator.passback_cache.misses)
+        metrics.increment('invalid_records', validator.statistics['invalid_records'])
+
+        if load_result is not False:
+            # Сдвигаем watermark только после успешного коммита
+            if args.incremental:
+                save_watermark(state_file, run_params['client'], run_params['end'])
+                logger.info(f"Watermark сохранен: {run_params['end']}")
+
+            logger.info("Процесс успешно завершен")
+            print("Процесс успешно завершен")
+    finally:
+        close_postgres_loaders()
+        # Метрики пишем и при исключении: иначе в metrics.prom остается успех прошлого запуска
+        # и алерт на самую частую ошибку (API недоступен) не срабатывает
+        metrics.success = load_result is not False
+        metrics.write_prometheus(metrics_dir / 'metrics.prom')
+        metrics.write_json(metrics_dir / 'run_summary.json')
+        logger.info(f"Метрики сохранены в: {metrics_dir}")
+
+    logger.info(f"Лог сохранен в: {logger.log_file}")
+    print(f"Лог-файл и ошибки сохранены в: {Path(project_root)}")
+    return 0 if load_result is not False else 1
 
-        # Удаляем CSV файл после успешного импорта
-        os.remove(csv_file_path)
-        logger.info(f"CSV файл удален: {csv_file_path}")
-                
-logger.info(f"Лог сохранен в: {logger.log_file}")
-print(f"Лог-файл и ошибки сохранены в: {Path(project_root)}")
 
+if __name__ == '__main__':
+    sys.exit(main())